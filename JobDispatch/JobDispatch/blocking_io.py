@@ -0,0 +1,31 @@
+import os
+import asyncio
+import functools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+# Each kind of blocking work gets its own bounded pool, so a slow Supabase call
+# can never starve a borrower-file read (and neither ever runs on the event loop)
+POOL_SIZES = {
+    "blob": int(os.getenv("BLOB_IO_THREADS", "2")),
+    "db": int(os.getenv("DB_IO_THREADS", "4")),
+    "parse": int(os.getenv("PARSE_IO_THREADS", "1")),
+    "llm": int(os.getenv("LLM_IO_THREADS", "4")),
+}
+
+_executors = {}
+_executors_lock = threading.Lock()
+
+def get_executor(pool):
+    with _executors_lock:
+        if pool not in _executors:
+            _executors[pool] = ThreadPoolExecutor(
+                max_workers=POOL_SIZES[pool],
+                thread_name_prefix=f"{pool}-io"
+            )
+        return _executors[pool]
+
+async def run_blocking(pool, function, *args, **kwargs):
+    """Runs a synchronous call on the named thread pool and awaits its result without blocking the event loop."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(get_executor(pool), functools.partial(function, *args, **kwargs))
@@ -0,0 +1,144 @@
+"""
+Tiered choice between the WhatsApp and the voice agent for SuperAgent.decide_agent.
+
+1. Keyword rules: English, Hindi and Hinglish phrases that explicitly ask for (or refuse) a call or a message.
+2. Preference: a response that does not talk about the channel at all follows the stored preference.
+3. LLM arbiter: only for responses that mention the channel in a way the rules cannot settle.
+
+Decisions are cached per normalized response, so a repeated reply never reaches the LLM twice.
+"""
+
+import os
+import re
+import string
+import threading
+from collections import OrderedDict
+
+WHATSAPP = "whatsapp_agent"
+VOICE = "voice_agent"
+
+ROUTER_CACHE_SIZE = int(os.getenv("ROUTER_CACHE_SIZE", "4096"))
+
+#Sentence and clause punctuation becomes a line break, which no rule matches across, so the "no" in "No, call me" is not read as "no call"
+CLAUSE_BREAKS = ".,;:!?।॥\n"
+PUNCTUATION = str.maketrans({character: "\n" if character in CLAUSE_BREAKS else " "
+                             for character in string.punctuation + CLAUSE_BREAKS})
+
+CALL = r"(?:call|phone|ring|कॉल|काल|फ़ोन|फोन)"
+MESSAGE = r"(?:message|msg|text|sms|whats ?app|chat|मैसेज|मेसेज|संदेश|व्हाट्सएप|व्हाट्सऐप|वॉट्सऐप)"
+TALK = r"(?:talk|speak|baat|बात)"
+#\b does not work after Devanagari vowel signs; words are separated by single spaces and clauses by line breaks
+START = r"(?<!\S)"
+END = r"(?!\S)"
+
+#Refusals are matched first and cut out of the text, so "don't call me" is not read as "call me"
+REFUSE_CALL = [
+    rf"{START}(?:don ?t|do not|dont|never|stop) {CALL}",
+    rf"{START}no (?:more )?{CALL}s{END}",
+    rf"{START}{CALL} (?:mat|na|nahi|nahin|मत|ना|नहीं){END}",
+    rf"{START}(?:mat|मत) {CALL}",
+    rf"{START}(?:don ?t|do not|dont|can ?t|cannot|not able to) (?:want to )?{TALK}",
+    rf"{START}(?:abhi|अभी) {TALK} (?:nahi|nahin|नहीं|mat|मत)",
+    rf"{START}{TALK} (?:nahi|nahin|नहीं) (?:kar|कर)",
+    rf"{START}(?:i m|i am|im|main|मैं) (?:busy|in a meeting|driving){END}",
+    rf"{START}(?:busy (?:hoon|hu|hun)|व्यस्त (?:हूँ|हूं))",
+    rf"{START}not (?:a )?(?:good|right) time{END}",
+    rf"{START}not (?:right )?now{END}",
+    rf"{START}(?:abhi|अभी) (?:nahi|nahin|नहीं|mat|मत){END}",
+]
+REFUSE_MESSAGE = [
+    rf"{START}(?:don ?t|do not|dont|never|stop) {MESSAGE}",
+    rf"{START}no (?:more )?{MESSAGE}s{END}",
+    rf"{START}{MESSAGE} (?:mat|na|nahi|nahin|मत|ना|नहीं){END}",
+    rf"{START}(?:mat|मत) {MESSAGE}",
+]
+ASK_CALL = [
+    rf"{START}{CALL} (?:me|karo|kariye|kijiye|kar do|kar dena|करो|करें|कीजिए|कर दो|कर देना){END}",
+    rf"{START}(?:prefer|want|like|rather) (?:a |to )?(?:be )?(?:{CALL}|called)",
+    rf"{START}(?:{TALK}) (?:to|with) (?:someone|somebody|a person|an agent|an executive|you){END}",
+    rf"{START}(?:{TALK}) (?:karni|karna|karenge|karunga|करनी|करना|करेंगे|करूंगा){END}",
+    rf"{START}(?:on|over|by|pe|par|पर|पे) (?:the )?{CALL}{END}",
+    rf"{START}{CALL} (?:pe|par|पर|पे){END}",
+    rf"{START}give (?:me )?a {CALL}",
+]
+ASK_MESSAGE = [
+    rf"{START}{MESSAGE} (?:me|karo|kariye|kijiye|kar do|kar dena|bhejo|bhej do|करो|करें|कीजिए|कर दो|भेजो|भेज दो){END}",
+    rf"{START}(?:send|drop) (?:me )?(?:a |the )?(?:details )?(?:on )?{MESSAGE}",
+    rf"{START}(?:prefer|want|like|rather) (?:a |to )?(?:be )?(?:{MESSAGE}|messaged|texted)",
+    rf"{START}(?:on|over|by|via|pe|par|पर|पे) (?:the )?{MESSAGE}{END}",
+    rf"{START}{MESSAGE} (?:pe|par|पर|पे){END}",
+]
+#Any of these means the response talks about the channel, so the preference alone cannot decide it
+CHANNEL_WORDS = re.compile(rf"{START}(?:{CALL}|{MESSAGE}|{TALK}|later|busy|reach|contact|not now|abhi nahi|बाद में|अभी नहीं)")
+
+
+REFUSE_CALL, REFUSE_MESSAGE, ASK_CALL, ASK_MESSAGE = (
+    [re.compile(pattern) for pattern in patterns] for patterns in (REFUSE_CALL, REFUSE_MESSAGE, ASK_CALL, ASK_MESSAGE)
+)
+
+
+def normalize(response):
+    """Lowercases, drops punctuation (keeping Devanagari vowel signs), puts each clause on its own line and collapses whitespace."""
+    clauses = (" ".join(clause.split()) for clause in str(response).lower().translate(PUNCTUATION).split("\n"))
+    return "\n".join(clause for clause in clauses if clause)
+
+
+def classify(text):
+    """Returns WHATSAPP or VOICE when the normalized text settles the choice on its own, otherwise None."""
+    votes = set()
+    for patterns, agent in ((REFUSE_CALL, WHATSAPP), (REFUSE_MESSAGE, VOICE)):
+        for pattern in patterns:
+            text, matched = pattern.subn(" ", text)
+            if matched:
+                votes.add(agent)
+    for patterns, agent in ((ASK_CALL, VOICE), (ASK_MESSAGE, WHATSAPP)):
+        if any(pattern.search(text) for pattern in patterns):
+            votes.add(agent)
+    return votes.pop() if len(votes) == 1 else None
+
+
+def mentions_channel(text):
+    return CHANNEL_WORDS.search(text) is not None
+
+
+class ChannelRouter:
+    """Routes responses through the rules, the preference and the cache before falling back to the LLM."""
+
+    def __init__(self, cache_size=ROUTER_CACHE_SIZE):
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+        self.counts = {"rule": 0, "preference": 0, "cache": 0, "llm": 0}
+        self._lock = threading.Lock()
+
+    def route(self, response, preference, ask_llm):
+        """`ask_llm(response)` is only called when neither the rules nor the preference can decide."""
+        text = normalize(response)
+        key = (preference, text)
+        with self._lock:
+            if key in self.cache:
+                self.cache.move_to_end(key)
+                self.counts["cache"] += 1
+                return self.cache[key]
+
+        decision, source = classify(text), "rule"
+        if decision is None and not mentions_channel(text):
+            decision, source = (WHATSAPP if preference == "message" else VOICE), "preference"
+        if decision is None:
+            decision, source = ask_llm(response), "llm"
+
+        with self._lock:
+            self.counts[source] += 1
+            self.cache[key] = decision
+            if len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+        return decision
+
+    def stats(self):
+        with self._lock:
+            counts = dict(self.counts)
+            cached = len(self.cache)
+        total = sum(counts.values())
+        counts["total"] = total
+        counts["cached_responses"] = cached
+        counts["llm_avoided_rate"] = round(1 - counts["llm"] / total, 4) if total else 0.0
+        return counts
@@ -1,84 +1,241 @@
 import os
 import json
-import pandas as pd
+import asyncio
+import time
+import socket
+import threading
+import hashlib
 import tempfile
-from supabase import create_client, Client
+import pandas as pd
+from pandas.api.types import union_categoricals
+import pyarrow as pa
+import pyarrow.feather as feather
+import httpx
+from postgrest import AsyncPostgrestClient
+from postgrest.constants import DEFAULT_POSTGREST_CLIENT_HEADERS
+from postgrest.exceptions import APIError
+from postgrest.types import ReturnMethod
 from datetime import datetime
+from azure.core import MatchConditions
 from azure.identity import DefaultAzureCredential
 from azure.storage.blob import BlobServiceClient
 
-from clean_variables import money_to_words, date_to_words
+from clean_variables import money_column_to_words, date_column_to_words, parse_date_column
 import RAGer as rag
 
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "remote")
+
 class UserData:
     def __init__(self):
         self.Data = None
+        self.Spoken = None
+        self.index = {}
+        self.phone_positions = None
         self.important_fields = [
-            'F_Name', 'L_Name', "Gender", 'Mobile_No', "Income", 'Bureau_score',
-            "Loan_amount", "Loan_type", "Interest_Rate", 'Interest', 'Loan_Processing_Fee', "Current_balance",
-            "Installment_Amount",
-            'Disbursal_Date', "Repayment_Start_Date", "Repayment_tenure", "Date_of_last_payment", 'Repayment_mode',
-            "No_of_late_payments"
+            'F_Name', 'L_Name', 'Gender', 'Mobile_No', 'Income', 'Bureau_score',
+            'Loan_amount', 'Loan_type', 'Interest_Rate', 'Loan_Processing_Fee', 'Current_balance',
+            'Installment_Amount', 'Repayment_Start_Date', 'Repayment_tenure', 'Date_of_last_payment',
+            'Repayment_mode', 'No_of_late_payments', 'Next_due_date', 'Pending_days',
+            'Minimum_amount_due', 'Late_Fees', 'Eligible_for_EMI'
         ]
+        self.field_dtypes = {
+            'F_Name': 'string[pyarrow]', 'L_Name': 'string[pyarrow]', 'Mobile_No': 'int64',
+            'Gender': 'category', 'Loan_type': 'category', 'Repayment_mode': 'category', 'Eligible_for_EMI': 'category'
+        }
+        self.date_fields = ['Repayment_Start_Date', 'Date_of_last_payment', 'Next_due_date']
+        self.chunk_rows = int(os.getenv("BORROWER_CHUNK_ROWS", "100000"))
+        self.memory_map = os.getenv("BORROWER_MMAP", "0") == "1"
         self.account_name = os.getenv("AZURE_STORAGE_ACCOUNT_NAME")
         self.container_name = os.getenv("AZURE_CONTAINER_NAME")
         self.connection_string = os.getenv("AZURE_STORAGE_CONNECTION_STRING")
         self.blob_name = "borrower.csv"
+        self.cache_dir = os.getenv("BORROWER_CACHE_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "cache"))
+        self.etag = None
 
-    def read_file(self, file_name="borrower.csv"):
-        try:
-            blob_service_client = BlobServiceClient.from_connection_string(self.connection_string)
-            container_client = blob_service_client.get_container_client(self.container_name)
-            blob_client = container_client.get_blob_client(file_name)  # use file_name instead of self.blob_name
+    def get_blob_client(self, file_name):
+        blob_service_client = BlobServiceClient.from_connection_string(self.connection_string)
+        container_client = blob_service_client.get_container_client(self.container_name)
+        return container_client.get_blob_client(file_name)  # use file_name instead of self.blob_name
+
+    def sync_file(self, file_name="borrower.csv"):
+        """
+        Keeps a verified local copy of the blob in `cache_dir` and returns (path, etag).
 
-            print(f"Downloading {file_name} from Azure Blob Storage...")
+        The download is conditional on the cached ETag, so an unchanged blob costs one 304 round trip.
+        If Azure is unreachable the cached copy is served as long as its checksum still matches.
+        """
+        os.makedirs(self.cache_dir, exist_ok=True)
+        local_path = os.path.join(self.cache_dir, file_name)
+        meta_path = f"{local_path}.meta.json"
 
-            with tempfile.NamedTemporaryFile(delete=False, suffix=".csv") as tmp_file:
+        meta = {}
+        try:
+            with open(meta_path, "r") as meta_file:
+                meta = json.load(meta_file)
+        except (OSError, ValueError):
+            meta = {}           #Missing or unreadable sidecar: treated as not cached, and rewritten below
+        cached = bool(meta) and self.verify_file(local_path, meta)
+
+        try:
+            blob_client = self.get_blob_client(file_name)
+            if cached:
+                blob_data = blob_client.download_blob(etag=meta['etag'], match_condition=MatchConditions.IfModified)
+            else:
                 blob_data = blob_client.download_blob()
-                tmp_file.write(blob_data.readall())
-                temp_file_path = tmp_file.name  # Save path before closing
+            content = blob_data.readall()
+        except Exception as e:
+            if not cached:
+                raise
+            if getattr(e, 'status_code', None) == 304:
+                print(f"{file_name} is unchanged since {meta['last_modified']}, using the local copy.")
+            else:
+                print(f"Could not reach Azure Blob Storage ({e}), using the local copy of {file_name}.")
+            return local_path, meta['etag']
+
+        content_md5 = blob_data.properties.content_settings.content_md5
+        if content_md5 and bytes(content_md5) != hashlib.md5(content).digest():
+            raise ValueError(f"Checksum mismatch while downloading {file_name}")
+
+        # Write to a temp file first so a crash never leaves a half-written cache behind
+        with tempfile.NamedTemporaryFile(dir=self.cache_dir, delete=False, suffix=".part") as tmp_file:
+            tmp_file.write(content)
+        os.replace(tmp_file.name, local_path)
+
+        meta = {
+            "etag": blob_data.properties.etag,
+            "last_modified": blob_data.properties.last_modified.isoformat(),
+            "size": len(content),
+            "sha256": hashlib.sha256(content).hexdigest()
+        }
+        with tempfile.NamedTemporaryFile("w", dir=self.cache_dir, delete=False, suffix=".part") as tmp_file:
+            json.dump(meta, tmp_file)
+        os.replace(tmp_file.name, meta_path)
+
+        print(f"Downloaded {file_name} to local cache: {local_path}")
+        return local_path, meta['etag']
+
+    def verify_file(self, path, meta):
+        if not os.path.exists(path) or os.path.getsize(path) != meta.get('size'):
+            return False
+        sha256 = hashlib.sha256()
+        with open(path, "rb") as cached_file:
+            for block in iter(lambda: cached_file.read(1 << 20), b""):
+                sha256.update(block)
+        return sha256.hexdigest() == meta.get('sha256')
+
+    def load_file(self, path, etag=None):
+        self.Data = self.read_compact(path)
+        self.etag = etag
+        self.Spoken = self.load_spoken(path)
+        self.build_index()
+
+    def read_compact(self, path):
+        """Streams the CSV in chunks, keeping only important_fields with the tightest safe dtypes."""
+        reader = pd.read_csv(path, usecols=self.important_fields, dtype=self.field_dtypes, chunksize=self.chunk_rows)
+        chunks = [self.compact_chunk(chunk) for chunk in reader]
+        if not chunks:
+            return pd.read_csv(path, usecols=self.important_fields, dtype=self.field_dtypes)
+
+        # Each chunk infers its own categories, so they are merged rather than letting concat fall back to objects
+        categories = [field for field, dtype in self.field_dtypes.items() if dtype == 'category']
+        data = pd.concat([chunk.drop(columns=categories) for chunk in chunks], ignore_index=True)
+        for field in categories:
+            data[field] = union_categoricals([chunk[field] for chunk in chunks])
+        return data[self.important_fields]
+
+    def compact_chunk(self, chunk):
+        for field in chunk.columns:
+            # Floats are left alone: money_to_words speaks "12500.0" and "12500" differently
+            if field != 'Mobile_No' and pd.api.types.is_integer_dtype(chunk[field]):
+                chunk[field] = pd.to_numeric(chunk[field], downcast='integer')
+        for field in self.date_fields:
+            chunk[field] = parse_date_column(chunk[field])
+        return chunk
+
+    def load_spoken(self, path):
+        """
+        Returns the borrower table in the spoken form served by fetch_user, as an Arrow table.
 
-            print(f"Downloaded to temporary file: {temp_file_path}")
-            
-            # Read CSV from temp file
-            self.Data = pd.read_csv(temp_file_path)
+        The conversion runs once per file version: the result is cached in `cache_dir` as an Arrow
+        file tagged with the source ETag and reused until the blob changes. With BORROWER_MMAP=1 the
+        file is written uncompressed and memory-mapped, so worker processes on a host share its pages.
+        """
+        os.makedirs(self.cache_dir, exist_ok=True)
+        spoken_path = os.path.join(self.cache_dir, f"{os.path.splitext(os.path.basename(path))[0]}.spoken.arrow")
+        compression = "uncompressed" if self.memory_map else "lz4"
+        tags = {b"source_etag": (self.etag or "").encode(), b"compression": compression.encode()}
 
-            # Clean up
-            os.remove(temp_file_path)
+        if self.etag and os.path.exists(spoken_path):
+            table = feather.read_table(spoken_path, memory_map=self.memory_map)
+            metadata = table.schema.metadata or {}
+            if all(metadata.get(key) == value for key, value in tags.items()):
+                return table
+
+        table = pa.Table.from_pandas(self.build_spoken(), preserve_index=False)
+        if not self.etag:
+            return table
+
+        table = table.replace_schema_metadata({**table.schema.metadata, **tags})
+        with tempfile.NamedTemporaryFile(dir=self.cache_dir, delete=False, suffix=".part") as tmp_file:
+            feather.write_feather(table, tmp_file.name, compression=compression)
+        os.replace(tmp_file.name, spoken_path)
+        return feather.read_table(spoken_path, memory_map=True) if self.memory_map else table
+
+    def build_spoken(self):
+        """Converts the whole borrower table to spoken form in one column-wise pass; repetitive phrases are kept as categoricals."""
+        data = self.Data
+        return pd.DataFrame({
+            "first_name": data['F_Name'],
+            "last_name": data['L_Name'],
+            "phone_no": data['Mobile_No'],
+            "gender": data['Gender'],
+            "income_in_inr": money_column_to_words(data['Income']),
+            "credit_score": data['Bureau_score'],
+            "loan_type": data['Loan_type'],
+            "loan_amount": money_column_to_words(data['Loan_amount']),
+            "interest_rate": (data['Interest_Rate'].astype(str) + " percent").astype('category'),
+            "process_fee": money_column_to_words(data['Loan_Processing_Fee']),
+            "installment": money_column_to_words(data['Installment_Amount']),
+            "start_date": date_column_to_words(data['Repayment_Start_Date']),
+            "tenure": (data['Repayment_tenure'].astype(str) + " months").astype('category'),
+            "balance_to_pay": money_column_to_words(data['Current_balance']),
+            "payment_mode": data['Repayment_mode'],
+            "late_payment": data['No_of_late_payments'],
+            "last_date": date_column_to_words(data['Date_of_last_payment']),
+            "due_date": date_column_to_words(data['Next_due_date']),
+            "pending_days": data['Pending_days'],
+            "minimum_due_amount": money_column_to_words(data['Minimum_amount_due']),
+            "late_fees": money_column_to_words(data["Late_Fees"]),
+            "emi_eligible": data["Eligible_for_EMI"]
+        })
+
+    def read_file(self, file_name="borrower.csv"):
+        try:
+            local_path, etag = self.sync_file(file_name)
+            if self.Data is not None and etag == self.etag:
+                return
+            self.load_file(local_path, etag)
 
         except Exception as e:
             print(f"Error downloading or reading CSV from Azure Blob Storage: {e}")
             self.Data = None
+            self.Spoken = None
+            self.index = {}
+
+    def build_index(self):
+        """Maps each phone number to its row position so fetch_user is a dict lookup instead of a table scan."""
+        index = {}
+        for position, phone in enumerate(self.Data['Mobile_No'].tolist()):
+            index.setdefault(int(phone), position)
+        self.index = index
+        self.phone_positions = pd.Series(list(index.values()), index=list(index.keys()), dtype='int64')
 
     def fetch_user(self,phone_no):
         try:
             phone_no = int(phone_no)
-            if phone_no in self.Data['Mobile_No'].values:
-                user_data = self.Data.loc[self.Data['Mobile_No'] == phone_no]
-                user_info = {
-                    "first_name": user_data['F_Name'].item(),
-                    "last_name": user_data['L_Name'].item(),
-                    "phone_no": user_data['Mobile_No'].item(),
-                    "gender": user_data['Gender'].item(),
-                    "income_in_inr": money_to_words(user_data['Income'].item()),
-                    "credit_score": user_data['Bureau_score'].item(),
-                    "loan_type": user_data['Loan_type'].item(),
-                    "loan_amount": money_to_words(user_data['Loan_amount'].item()),
-                    "interest_rate": f"{user_data['Interest_Rate'].item()} percent",
-                    "process_fee": money_to_words(user_data['Loan_Processing_Fee'].item()),
-                    "installment": money_to_words(user_data['Installment_Amount'].item()),
-                    "start_date": date_to_words(user_data['Repayment_Start_Date'].item()),
-                    "tenure": f"{user_data['Repayment_tenure'].item()} months",
-                    "balance_to_pay": money_to_words(user_data['Current_balance'].item()),
-                    "payment_mode": user_data['Repayment_mode'].item(),
-                    "late_payment": user_data['No_of_late_payments'].item(),
-                    "last_date": date_to_words(user_data['Date_of_last_payment'].item()),
-                    "due_date": date_to_words(user_data['Next_due_date'].item()),
-                    "pending_days": user_data['Pending_days'].item(),
-                    "minimum_due_amount": money_to_words(user_data['Minimum_amount_due'].item()),
-                    "late_fees": money_to_words(user_data["Late_Fees"].item()),
-                    "emi_eligible": user_data["Eligible_for_EMI"].item()
-                }
+            position = self.index.get(phone_no)
+            if position is not None:
+                user_info = self.records(self.Spoken.slice(position, 1))[0]
                 return user_info
             else:
                 print('User does not exist.')
@@ -87,27 +244,287 @@ class UserData:
             print(f'Such a Phone Number does not exist in {self.file_path}')
             return {}
 
+    def fetch_users(self, phone_numbers):
+        """
+        Resolves a whole dialing list with one vectorized join against the phone index.
+
+        Returns (users, missing): users maps each phone number, as given, to the same dict fetch_user
+        returns, and missing lists the numbers that are not in the borrower file.
+        """
+        phone_numbers = list(phone_numbers)
+        phones = pd.to_numeric(pd.Series(phone_numbers, dtype=object), errors='coerce')
+        positions = self.phone_positions.reindex(phones).to_numpy()
+        found = ~pd.isna(positions)
+
+        rows = self.records(self.Spoken.take(pa.array(positions[found].astype('int64'))))
+        found_numbers = [phone for phone, is_found in zip(phone_numbers, found) if is_found]
+        missing = [phone for phone, is_found in zip(phone_numbers, found) if not is_found]
+        return dict(zip(found_numbers, rows)), missing
+
+    def priority_fields(self, phone_numbers, fields=('Pending_days', 'Next_due_date', 'No_of_late_payments', 'Minimum_amount_due')):
+        """Raw (not spoken) `fields` of the given borrowers as a DataFrame indexed by phone number as given; unknown numbers are left out."""
+        phone_numbers = list(phone_numbers)
+        phones = pd.to_numeric(pd.Series(phone_numbers, dtype=object), errors='coerce')
+        positions = self.phone_positions.reindex(phones).to_numpy()
+        found = ~pd.isna(positions)
+
+        rows = self.Data.iloc[positions[found].astype('int64')][list(fields)]
+        rows.index = [phone for phone, is_found in zip(phone_numbers, found) if is_found]
+        return rows
+
+    def select_phones(self, min_pending_days=None, max_pending_days=None, min_late_payments=None,
+                      loan_types=None, due_before=None, limit=None):
+        """Phone numbers of the borrowers matching every given criterion, in file order, as one vectorized mask."""
+        data = self.Data
+        mask = pd.Series(True, index=data.index)
+        if min_pending_days is not None:
+            mask &= data['Pending_days'] >= min_pending_days
+        if max_pending_days is not None:
+            mask &= data['Pending_days'] <= max_pending_days
+        if min_late_payments is not None:
+            mask &= data['No_of_late_payments'] >= min_late_payments
+        if loan_types:
+            mask &= data['Loan_type'].isin(loan_types)
+        if due_before is not None:
+            mask &= data['Next_due_date'] <= pd.Timestamp(due_before)
+
+        phones = data.loc[mask, 'Mobile_No'].drop_duplicates()
+        if limit is not None:
+            phones = phones.head(limit)
+        return [str(phone) for phone in phones.tolist()]
+
+    def records(self, table):
+        """Converts Arrow rows to plain dicts; decoding dictionary columns first is far faster than to_pylist on them."""
+        columns = {}
+        for name, column in zip(table.column_names, table.columns):
+            if pa.types.is_dictionary(column.type):
+                column = column.cast(column.type.value_type)
+            columns[name] = column.to_pylist()
+        return [dict(zip(columns, values)) for values in zip(*columns.values())]
+
+class BorrowerStore:
+    """
+    Process-wide borrower lookup table.
+
+    The borrower file is read once per process and re-read on a background thread every
+    `BORROWER_REFRESH_SECONDS`, so lookups made during a call never touch Azure or pandas I/O.
+    """
+
+    _instance = None
+    _instance_lock = threading.Lock()
+
+    def __init__(self, file_name="borrower.csv", refresh_interval=None):
+        self.file_name = file_name
+        self.refresh_interval = refresh_interval or int(os.getenv("BORROWER_REFRESH_SECONDS", "900"))
+        self.retry_interval = int(os.getenv("BORROWER_RETRY_SECONDS", "30"))
+        self.user_data = None
+        self.loaded_at = None
+        self.last_error = None          #Why the latest refresh failed; None after a successful one
+        self.ready = threading.Event()
+        self._started = False
+        self._lock = threading.Lock()
+
+    @classmethod
+    def get(cls):
+        with cls._instance_lock:
+            if cls._instance is None:
+                cls._instance = cls()
+            return cls._instance
+
+    def start(self):
+        """Starts the background loader once; later calls are no-ops."""
+        with self._lock:
+            if self._started:
+                return self
+            self._started = True
+
+        thread = threading.Thread(target=self._refresh_loop, name="borrower-store-refresh", daemon=True)
+        thread.start()
+        return self
+
+    def refresh(self):
+        data = create_user_data()
+        try:
+            local_path, etag = data.sync_file(self.file_name)
+            if self.user_data is not None and etag == self.user_data.etag:
+                return True
+            data.load_file(local_path, etag)
+        except Exception as e:
+            print(f"Borrower refresh failed, keeping the previous snapshot: {e}")
+            self.last_error = f"{type(e).__name__}: {e}"
+            return False
+
+        # Swapping the reference is atomic, so readers always see a complete snapshot
+        self.user_data = data
+        self.loaded_at = time.time()
+        self.last_error = None
+        self.ready.set()
+        print(f"Loaded {len(data.index)} borrowers into the in-memory store.")
+        return True
+
+    def _refresh_loop(self):
+        while True:
+            loaded = self.refresh()
+            time.sleep(self.refresh_interval if loaded else self.retry_interval)
+
+    def wait_ready(self, timeout=None):
+        return self.ready.wait(timeout)
+
+    def fetch_user(self, phone_no):
+        user_data = self.user_data
+        if user_data is None:
+            print('Borrower data is not loaded yet.')
+            return {"Error": "Borrower data is not loaded yet."}
+        return user_data.fetch_user(phone_no)
+
+    def fetch_users(self, phone_numbers):
+        user_data = self.user_data
+        if user_data is None:
+            return {}, list(phone_numbers)
+        return user_data.fetch_users(phone_numbers)
+
+    def priority_fields(self, phone_numbers, **kwargs):
+        user_data = self.user_data
+        if user_data is None:
+            return pd.DataFrame()
+        return user_data.priority_fields(phone_numbers, **kwargs)
+
+    def select_phones(self, **criteria):
+        user_data = self.user_data
+        if user_data is None:
+            return []
+        return user_data.select_phones(**criteria)
+
+class MeteredTransport(httpx.AsyncHTTPTransport):
+    """HTTP transport that keeps counters for the pool metrics exposed by Database.pool_stats."""
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.stats = {"requests": 0, "in_flight": 0, "errors": 0, "total_latency_ms": 0.0}
+
+    async def handle_async_request(self, request):
+        self.stats["requests"] += 1
+        self.stats["in_flight"] += 1
+        started = time.perf_counter()
+        try:
+            return await super().handle_async_request(request)
+        except Exception:
+            self.stats["errors"] += 1
+            raise
+        finally:
+            self.stats["in_flight"] -= 1
+            self.stats["total_latency_ms"] += 1000 * (time.perf_counter() - started)
+
+    def pool_stats(self):
+        connections = self._pool.connections
+        stats = dict(self.stats)
+        stats["open_connections"] = len(connections)
+        stats["idle_connections"] = sum(1 for connection in connections if connection.is_idle())
+        stats["mean_latency_ms"] = round(stats["total_latency_ms"] / stats["requests"], 2) if stats["requests"] else 0.0
+        return stats
+
+    def abandon(self):
+        """Shuts down the connections of a pool whose event loop has stopped and can no longer run aclose()."""
+        for connection in self._pool.connections:
+            stream = getattr(getattr(connection, "_connection", None), "_network_stream", None)
+            sock = stream.get_extra_info("socket") if stream is not None else None
+            if sock is not None:
+                try:
+                    sock.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+
+class PooledPostgrestClient(AsyncPostgrestClient):
+    """PostgREST client on a bounded pool of keep-alive HTTP/2 connections."""
+
+    def create_session(self, base_url, headers, timeout, verify=True, proxy=None):
+        self.transport = MeteredTransport(
+            verify=verify,
+            proxy=proxy,
+            http2=True,
+            limits=httpx.Limits(
+                max_connections=int(os.getenv("SUPABASE_MAX_CONNECTIONS", "20")),
+                max_keepalive_connections=int(os.getenv("SUPABASE_KEEPALIVE_CONNECTIONS", "10")),
+                keepalive_expiry=float(os.getenv("SUPABASE_KEEPALIVE_SECONDS", "60")),
+            ),
+        )
+        return httpx.AsyncClient(
+            base_url=base_url,
+            headers=headers,
+            timeout=timeout,
+            follow_redirects=True,
+            transport=self.transport,
+        )
+
 class Database:
+    """
+    Supabase access for conversation history.
+
+    Every Database in the process shares one pooled async client, so a post-call flush or a
+    pre-dispatch summary fetch reuses warm connections instead of paying TLS setup again.
+    """
+
+    _client = None
+    _client_loop = None
+
     def __init__(self):
-        url = os.environ.get("SUPABASE_URL")
-        key = os.environ.get("SUPABASE_KEY")
-        self.supabase: Client = create_client(url, key)
-
-    def init_user(self, phone: str, wa_id=None, chat_id=None, name=None):
-        response = self.supabase.table("agent-users").select("*").eq("phone", phone).execute()
-        
-        if not response.data: 
-            data = {
-                "phone": phone,
-                "whatsapp_id": wa_id,
-                "chat_id": chat_id,
-                "name": name,
-                "whatsapp_messages": [],
-                "call_transcripts": []
-            }
-            self.supabase.table("agent-users").insert(data).execute()
-        
-        return phone 
+        self.url = os.environ.get("SUPABASE_URL")
+        self.key = os.environ.get("SUPABASE_KEY")
+
+    @property
+    def supabase(self) -> AsyncPostgrestClient:
+        # httpx connections belong to the event loop that opened them, so the client is per loop (i.e. per process)
+        loop = asyncio.get_running_loop()
+        if Database._client is None or Database._client_loop is not loop:
+            if Database._client is not None:
+                Database._discard_client(Database._client, Database._client_loop)
+            Database._client = PooledPostgrestClient(
+                f"{self.url}/rest/v1",
+                headers={**DEFAULT_POSTGREST_CLIENT_HEADERS, "apikey": self.key, "Authorization": f"Bearer {self.key}"},
+                timeout=float(os.getenv("SUPABASE_TIMEOUT_SECONDS", "10")),
+            )
+            Database._client_loop = loop
+        return Database._client
+
+    @staticmethod
+    def _discard_client(client, loop):
+        # The old client can only be closed on its own loop; once that loop has stopped its sockets are closed directly
+        if loop.is_running():
+            asyncio.run_coroutine_threadsafe(client.aclose(), loop)
+        else:
+            client.transport.abandon()
+
+    @classmethod
+    def pool_stats(cls):
+        if cls._client is None:
+            return {"requests": 0, "open_connections": 0}
+        return cls._client.transport.pool_stats()
+
+    @classmethod
+    async def aclose(cls):
+        if cls._client is not None:
+            await cls._client.aclose()
+            cls._client = None
+            cls._client_loop = None
+
+    async def init_user(self, phone: str, wa_id=None, chat_id=None, name=None):
+        """Creates the user row if it is missing, in one atomic round trip; an existing row is left untouched."""
+        data = {
+            "phone": phone,
+            "whatsapp_id": wa_id,
+            "chat_id": chat_id,
+            "name": name,
+            "whatsapp_messages": [],
+            "call_transcripts": []
+        }
+        await self.supabase.table("agent-users").upsert(
+            data,
+            on_conflict="phone",
+            ignore_duplicates=True,
+            returning=ReturnMethod.minimal
+        ).execute()
+
+        return phone
 
     def payload(self, name, text, time):
         msg = {
@@ -116,58 +533,127 @@ class Database:
         }
         return msg
    
-    def add_convo(self, ref, agent, msg):
-        response = self.supabase.table("agent-users").select("*").eq("phone", ref).execute()
-        if not response.data:
-            raise Exception("User does not exist")
-
-        user_data = response.data[0]
-        if agent == "voice":
-            current_transcripts = user_data.get("call_transcripts", [])
-            # print(f"Before extend - Current transcripts: {current_transcripts}, New msg: {msg}") 
-            if isinstance(msg, list):
-                current_transcripts.extend(msg)
-            else:
-                print(f"Error: msg is not a list, got {type(msg)}: {msg}")
-                raise ValueError("msg must be a list of message dictionaries")
-            # print(f"After extend - Updated transcripts: {current_transcripts}")  
-            try:
-                self.supabase.table("agent-users").update({
-                    "call_transcripts": current_transcripts
-                }).eq("phone", ref).execute()
-            except Exception as e:
-                print(f"Supabase update failed: {e}")
-                raise
-        elif agent == "whatsapp":
-            current_messages = user_data.get("whatsapp_messages", [])
-            if isinstance(msg, list):
-                current_messages.extend(msg)
-            else:
-                raise ValueError("msg must be a list of message dictionaries")
-            self.supabase.table("agent-users").update({
-                "whatsapp_messages": current_messages
-            }).eq("phone", ref).execute()
-        else:
+    async def add_convo(self, ref, agent, msg):
+        """
+        Appends messages to the user's history as rows of the "agent-messages" table.
+
+        Each call inserts only the new messages in a single request, so the cost does not grow with the
+        length of the existing history and concurrent writers cannot overwrite each other.
+        """
+        if agent not in ("voice", "whatsapp"):
             raise Exception("Invalid Agent")
+        if not isinstance(msg, list):
+            print(f"Error: msg is not a list, got {type(msg)}: {msg}")
+            raise ValueError("msg must be a list of message dictionaries")
+        if not msg:
+            return
 
-    def get_convo(self, ref, agent):
-        response = self.supabase.table("agent-users").select("*").eq("phone", ref).execute()
-        if not response.data:
-            raise Exception("User does not exist")
-
-        user_data = response.data[0]
-        
-        if agent == "voice":
-            conversation = user_data["call_transcripts"]
-        elif agent == "whatsapp":
-            conversation = user_data["whatsapp_messages"]
-        else:
+        rows = []
+        for message in msg:
+            speaker, text = next((key, value) for key, value in message.items() if key != "timestamp")
+            rows.append({
+                "phone": ref,
+                "channel": agent,
+                "speaker": speaker,
+                "content": text,
+                "created_at": message.get("timestamp") or datetime.now().isoformat()
+            })
+
+        try:
+            await self.supabase.table("agent-messages").insert(rows).execute()
+        except APIError as e:
+            if e.code == "23503":       # foreign key violation: no "agent-users" row for this phone
+                raise Exception("User does not exist")
+            print(f"Supabase insert failed: {e}")
+            raise
+
+    async def get_convo(self, ref, agent, limit=10, offset=0):
+        """
+        Returns up to `limit` messages of one channel in chronological order, without timestamps.
+        `offset` pages backwards from the latest message, so offset=10 returns the ten before the last ten.
+        """
+        if agent not in ("voice", "whatsapp"):
             raise Exception("Invalid Agent")
 
-        for msg in conversation:
-            if "timestamp" in msg:
-                del msg["timestamp"]
+        response = await (
+            self.supabase.table("agent-messages")
+            .select("speaker,content")
+            .eq("phone", ref)
+            .eq("channel", agent)
+            .order("id", desc=True)
+            .range(offset, offset + limit - 1)
+            .execute()
+        )
 
-        latest_conversation = conversation[-10:]
+        latest_conversation = [{row["speaker"]: row["content"]} for row in reversed(response.data)]
         return latest_conversation
-    
\ No newline at end of file
+    
+    async def get_convos(self, ref, agents=("whatsapp", "voice"), limit=10):
+        """
+        Returns {agent: messages} with the latest `limit` messages of every requested channel,
+        fetched in a single call to the recent_messages database function.
+        """
+        response = await self.supabase.rpc("recent_messages", {"p_phone": ref, "p_limit": limit}).execute()
+
+        conversations = {agent: [] for agent in agents}
+        for row in response.data:
+            if row["channel"] in conversations:
+                conversations[row["channel"]].append({row["speaker"]: row["content"]})
+        return conversations
+
+    async def get_summary_state(self, ref, agents=("whatsapp", "voice"), limit=None):
+        """
+        Returns {agent: {"summary", "summarized_through", "messages", "last_id"}}: the stored rolling summary
+        of every channel and the messages added after it, in one call to summary_state. With `limit` only the
+        oldest `limit` new messages are returned, so last_id never skips a message that was not summarized.
+        """
+        response = await self.supabase.rpc("summary_state", {"p_phone": ref, "p_limit": limit}).execute()
+
+        state = {agent: {"summary": None, "summarized_through": 0, "messages": [], "last_id": 0} for agent in agents}
+        for row in response.data:
+            if row["channel"] not in state:
+                continue
+            channel = state[row["channel"]]
+            if row["id"] is None:
+                channel["summary"] = row["summary"]
+                channel["summarized_through"] = channel["last_id"] = row["summarized_through"]
+            else:
+                channel["messages"].append({row["speaker"]: row["content"]})
+                channel["last_id"] = row["id"]
+        return state
+
+    async def save_summaries(self, ref, summaries):
+        """Stores {agent: (summary, summarized_through)} as the user's rolling summaries in a single upsert."""
+        if not summaries:
+            return
+        rows = [
+            {
+                "phone": ref,
+                "channel": agent,
+                "summary": summary,
+                "summarized_through": through,
+                "updated_at": datetime.now().isoformat()
+            }
+            for agent, (summary, through) in summaries.items()
+        ]
+        await self.supabase.table("agent-summaries").upsert(
+            rows,
+            on_conflict="phone,channel",
+            returning=ReturnMethod.minimal
+        ).execute()
+
+
+def create_user_data():
+    """UserData for the configured STORAGE_BACKEND: Azure Blob Storage, or the local filesystem when "local"."""
+    if STORAGE_BACKEND == "local":
+        from local_storage import LocalUserData
+        return LocalUserData()
+    return UserData()
+
+
+def create_database():
+    """Database for the configured STORAGE_BACKEND: Supabase, or a SQLite file when "local"."""
+    if STORAGE_BACKEND == "local":
+        from local_storage import LocalDatabase
+        return LocalDatabase()
+    return Database()
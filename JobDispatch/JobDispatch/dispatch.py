@@ -5,66 +5,284 @@ from dotenv import load_dotenv
 load_dotenv()
 
 import asyncio
-import numpy as np
+import time
+import uuid
+import aiohttp
 import json
 from superAgent import SuperAgent
+from context_manager import BorrowerStore
+from inflight import InFlightRegistry
+from dispatch_context import build_context, compact_metadata
+from blocking_io import run_blocking
 from livekit import api
 from livekit.api import CreateRoomRequest
 
+READY_TIMEOUT = float(os.getenv("DISPATCH_READY_TIMEOUT_SECONDS", "30"))
+BATCH_CONCURRENCY = int(os.getenv("DISPATCH_BATCH_CONCURRENCY", "10"))
+BATCH_SLOT_SECONDS = float(os.getenv("DISPATCH_BATCH_SLOT_SECONDS", "600"))
 
-async def create_explicit_dispatch(customer_phone: str) -> dict:
-    LIVEKIT_URL = os.getenv('LIVEKIT_URL')
-    LIVEKIT_API_KEY = os.getenv("LIVEKIT_API_KEY")
-    LIVEKIT_API_SECRET = os.getenv("LIVEKIT_API_SECRET")
-
-    room_name = f'livekit_room_{np.random.randint(10 ** 8, 10 ** 9 - 1)}'
-
-    superagent = SuperAgent()
-    superagent.read_document('borrower.csv')
-    user_info = superagent.agent_context(customer_phone)
-
-    metadata = {
-        'phone': f"+91{customer_phone}",
-        'first_name': user_info['first_name'],
-        'last_name': user_info['last_name'],
-        'balance_to_pay': user_info['balance_to_pay'],
-        'installment': user_info['installment'],
-        'due_date': user_info['due_date'],
-        'pending_days': user_info['pending_days'],
-        'outstanding_amount': user_info['balance_to_pay'],
-        'minimum_due_amount': user_info['minimum_due_amount'],
-        'late_fees': user_info['late_fees'],
-        'interest_rate': user_info['interest_rate'],
-        'emi_eligible': user_info['emi_eligible'],
-        'whatsapp_summary': user_info['whatsapp_summary'],
-        'call_summary': user_info['call_summary'],
-        'use_context' : False,
 
-    }
+class WarmState:
+    """
+    SuperAgent and borrower table shared by every dispatch.
+
+    Both are built once by the app lifespan (see warm_up); the BorrowerStore keeps refreshing
+    the borrower file on its own thread, so a dispatch only does the customer-specific work.
+    """
+
+    superagent = None
+    task = None
+    started_at = None
+    timings = {}
+    error = None
+
+    @classmethod
+    def status(cls):
+        store = BorrowerStore.get()
+        ready = cls.superagent is not None and store.ready.is_set()
+        return {
+            "ready": ready,
+            "superagent_ready": cls.superagent is not None,
+            "borrowers_ready": store.ready.is_set(),
+            "borrower_count": len(store.user_data.index) if store.user_data is not None else 0,
+            "borrowers_loaded_at": store.loaded_at,
+            "borrowers_error": store.last_error,
+            "warmup_started_at": cls.started_at,
+            "warmup_seconds": dict(cls.timings),
+            "error": cls.error,
+        }
+
+
+def start_warm_up():
+    """Starts warming up in the background once, or again after a failed attempt; returns the warm-up task."""
+    task = WarmState.task
+    if task is None or (task.done() and (task.cancelled() or task.exception() is not None)):
+        WarmState.error = None
+        WarmState.task = asyncio.create_task(warm_up())
+    return WarmState.task
+
+
+async def warm_up():
+    WarmState.started_at = time.time()
+    started = time.perf_counter()
+    try:
+        store = BorrowerStore.get().start()
+
+        # Building the LLM clients is synchronous, so it runs on a worker thread while the borrower file loads
+        if WarmState.superagent is None:
+            stage = time.perf_counter()
+            WarmState.superagent = await run_blocking("parse", SuperAgent, store)
+            WarmState.timings["superagent"] = round(time.perf_counter() - stage, 3)
+
+        # A failed load fails the warm-up with its reason; the store keeps retrying and the next dispatch warms up again
+        while not store.ready.is_set():
+            if store.last_error is not None:
+                raise Exception(f"Borrower data could not be loaded: {store.last_error}")
+            await asyncio.sleep(0.05)
+        WarmState.timings["borrowers"] = round(time.perf_counter() - started, 3)
+    except Exception as e:
+        WarmState.error = str(e)
+        raise
+    finally:
+        WarmState.timings["total"] = round(time.perf_counter() - started, 3)
+
+
+async def ready_superagent() -> SuperAgent:
+    """Returns the shared SuperAgent, waiting up to READY_TIMEOUT for the warm-up to finish."""
+    try:
+        await asyncio.wait_for(asyncio.shield(start_warm_up()), timeout=READY_TIMEOUT)
+    except asyncio.TimeoutError:
+        raise Exception("Dispatch service is still warming up")
+    return WarmState.superagent
+
+
+class LiveKitClient:
+    """
+    One LiveKitAPI client per process, on a pooled keep-alive HTTP session.
+
+    Every dispatch reuses its warm connections to the LiveKit server instead of opening and
+    closing a session of its own; the app lifespan closes it on shutdown.
+    """
+
+    _client = None
+    _session = None
+    _client_loop = None
+
+    @classmethod
+    def get(cls) -> api.LiveKitAPI:
+        # aiohttp sessions belong to the event loop that opened them, like the Supabase client
+        loop = asyncio.get_running_loop()
+        if cls._client is None or cls._client_loop is not loop:
+            cls._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(
+                    limit=int(os.getenv("LIVEKIT_MAX_CONNECTIONS", "20")),
+                    keepalive_timeout=float(os.getenv("LIVEKIT_KEEPALIVE_SECONDS", "60")),
+                ),
+                timeout=aiohttp.ClientTimeout(total=float(os.getenv("LIVEKIT_TIMEOUT_SECONDS", "10"))),
+            )
+            cls._client = api.LiveKitAPI(
+                url=os.getenv('LIVEKIT_URL'),
+                api_key=os.getenv("LIVEKIT_API_KEY"),
+                api_secret=os.getenv("LIVEKIT_API_SECRET"),
+                session=cls._session,
+            )
+            cls._client_loop = loop
+        return cls._client
+
+    @classmethod
+    async def aclose(cls):
+        if cls._session is not None:
+            await cls._session.close()
+        cls._client = cls._session = cls._client_loop = None
+
+
+async def no_stage(stage):
+    pass
+
+
+async def timed(timings: dict, stage: str, awaitable):
+    started = time.perf_counter()
+    try:
+        return await awaitable
+    finally:
+        timings[stage] = round(time.perf_counter() - started, 3)
 
-    lkapi = api.LiveKitAPI(
-        url=LIVEKIT_URL,
-        api_key=LIVEKIT_API_KEY,
-        api_secret=LIVEKIT_API_SECRET
+
+async def dispatch_customer(superagent: SuperAgent, lkapi: api.LiveKitAPI, customer_phone, user_info=None, sip_trunk_id=None, on_stage=None):
+    """
+    Creates the customer's room and agent dispatch; returns (room_name, timings) with seconds per stage.
+
+    A number that is already being dispatched is not dialed again: the request shares that dispatch's result.
+    """
+    return await InFlightRegistry.get().run(
+        customer_phone,
+        lambda: create_room_and_dispatch(superagent, lkapi, customer_phone, user_info, sip_trunk_id, on_stage)
     )
 
-    room = await lkapi.room.create_room(CreateRoomRequest(
+
+async def create_room_and_dispatch(superagent: SuperAgent, lkapi: api.LiveKitAPI, customer_phone, user_info=None, sip_trunk_id=None, on_stage=None):
+    """
+    The room does not depend on the customer's context, so it is created while the summaries are built.
+    `on_stage(name)`, if given, is awaited as each stage starts.
+    """
+    on_stage = on_stage or no_stage
+    started = time.perf_counter()
+    timings = {}
+    room_name = f'livekit_room_{uuid.uuid4().hex}'
+
+    #Unknown numbers fail here, before a room, an agent-users row or any summarizer call is spent on them
+    if user_info is None:
+        user_info = await run_blocking("parse", superagent.file.fetch_user, phone_no=customer_phone)
+    if 'Error' in user_info:
+        raise Exception(user_info['Error'])
+
+    room = asyncio.create_task(timed(timings, "create_room", lkapi.room.create_room(CreateRoomRequest(
         name=room_name,
         empty_timeout=30,
         max_participants=2,
-    ))
+    ))))
+    try:
+        await on_stage("context")
+        user_info = await timed(timings, "context", superagent.agent_context(customer_phone, customer_data=user_info))
+        await room
+    except BaseException:
+        room.cancel()
+        raise
+    metadata = compact_metadata(build_context(customer_phone, user_info), sip_trunk_id)
 
-    dispatch = await lkapi.agent_dispatch.create_dispatch(
+    await on_stage("create_dispatch")
+    await timed(timings, "create_dispatch", lkapi.agent_dispatch.create_dispatch(
         api.CreateAgentDispatchRequest(
             agent_name='Predixion-Voice-Agent',
             room=room_name,
             metadata=json.dumps(metadata)
         )
-    )
+    ))
+
+    timings["total"] = round(time.perf_counter() - started, 3)
+    return room_name, timings
 
-    dispatches = await lkapi.agent_dispatch.list_dispatch(room_name=room_name)
-    await lkapi.aclose()
+
+async def create_explicit_dispatch(customer_phone: str, on_stage=None) -> dict:
+    on_stage = on_stage or no_stage
+    await on_stage("warm_up")
+    superagent = await ready_superagent()
+    room_name, timings = await dispatch_customer(superagent, LiveKitClient.get(), customer_phone, on_stage=on_stage)
 
     return {
-        "message": "Dispatch created"
+        "message": "Dispatch created",
+        "room": room_name,
+        "timings": timings
     }
+
+
+async def scheduled_dispatch(customer_phone, sip_trunk_id=None) -> str:
+    """Dispatch function of the CampaignScheduler: dials the number on the trunk it picked and returns the room name."""
+    superagent = await ready_superagent()
+    room_name, timings = await dispatch_customer(superagent, LiveKitClient.get(), customer_phone, sip_trunk_id=sip_trunk_id)
+    return room_name
+
+
+async def create_batch_dispatch(customer_phones, concurrency=None):
+    """
+    Dispatches a whole campaign and yields one result dict per number as soon as it is done.
+
+    Borrowers are resolved with a single bulk fetch_users, then `concurrency` workers (by default
+    DISPATCH_BATCH_CONCURRENCY) share the SuperAgent and the LiveKit client to summarize and dispatch
+    the numbers. Unknown numbers are reported up front.
+
+    A worker holds its slot until the call's outcome is reported to /dispatch/outcome (or for at most
+    DISPATCH_BATCH_SLOT_SECONDS), so `concurrency` bounds the live calls, not just the dispatches in
+    progress, and can be set to what the SIP trunk carries. The voice worker reports outcomes only
+    when DISPATCH_OUTCOME_URL is set; without it every slot is held for the full timeout.
+    """
+    concurrency = concurrency or BATCH_CONCURRENCY
+    customer_phones = list(dict.fromkeys(str(phone) for phone in customer_phones))
+    superagent = await ready_superagent()
+
+    users, missing = await run_blocking("parse", superagent.file.fetch_users, customer_phones)
+    for phone in missing:
+        yield {"phone": phone, "status": "not_found", "error": "User does not exist."}
+    if not users:
+        return
+
+    pending = asyncio.Queue()
+    for item in users.items():
+        pending.put_nowait(item)
+    results = asyncio.Queue()
+    lkapi = LiveKitClient.get()
+    inflight = InFlightRegistry.get()
+
+    async def worker():
+        while True:
+            try:
+                phone, user_info = pending.get_nowait()
+            except asyncio.QueueEmpty:
+                return
+            started = time.perf_counter()
+            call_ended = inflight.watch_release(phone)
+            try:
+                room_name, timings = await dispatch_customer(superagent, lkapi, phone, user_info)
+                result = {"phone": phone, "status": "dispatched", "room": room_name, "timings": timings}
+            except Exception as e:
+                result = {"phone": phone, "status": "failed", "error": str(e),
+                          "timings": {"total": round(time.perf_counter() - started, 3)}}
+            await results.put(result)
+
+            try:
+                if result["status"] == "dispatched":
+                    await asyncio.wait_for(call_ended, timeout=BATCH_SLOT_SECONDS)
+            except asyncio.TimeoutError:
+                pass
+            finally:
+                inflight.unwatch(phone, call_ended)
+
+    workers = [asyncio.create_task(worker()) for _ in range(min(concurrency, len(users)))]
+    try:
+        for _ in range(len(users)):
+            yield await results.get()
+    finally:
+        # Also reached when the client disconnects mid-stream, so the remaining numbers are not dialed
+        for task in workers:
+            task.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
@@ -0,0 +1,110 @@
+"""
+By-reference borrower context for LiveKit job metadata.
+
+Job metadata is a versioned envelope around the full context of a call (borrower fields and
+conversation summaries):
+
+    {"v": 2, "phone": "+91...", "context": {...}}                    inline, the default
+    {"v": 2, "phone": "+91...", "key": "<sha256 prefix>"}           by reference
+
+Passing by reference is opt-in: only when DISPATCH_CONTEXT_DIR is set, and it must then point at a
+volume shared by JobDispatch and the voice workers. JobDispatch writes the context there and sends
+just its key; if the write fails the context goes inline. Workers resolve the key from the same
+directory, and when it cannot be read they rebuild the context from their own BorrowerStore.
+Metadata without "v" is the original flat format and is still understood.
+"""
+
+import os
+import json
+import time
+import hashlib
+import tempfile
+
+METADATA_VERSION = 2
+CONTEXT_DIR = os.getenv("DISPATCH_CONTEXT_DIR")         #Unset: contexts are sent inline
+CONTEXT_TTL_SECONDS = 3600 * float(os.getenv("DISPATCH_CONTEXT_TTL_HOURS", "24"))
+
+_pruned_at = 0.0
+
+
+def build_context(customer_phone, user_info: dict) -> dict:
+    """The call context the voice agent expects, from a fetch_user/fetch_users record plus its summaries."""
+    return {
+        'phone': f"+91{customer_phone}",
+        'first_name': user_info['first_name'],
+        'last_name': user_info['last_name'],
+        'balance_to_pay': user_info['balance_to_pay'],
+        'installment': user_info['installment'],
+        'due_date': user_info['due_date'],
+        'pending_days': user_info['pending_days'],
+        'minimum_due_amount': user_info['minimum_due_amount'],
+        'late_fees': user_info['late_fees'],
+        'interest_rate': user_info['interest_rate'],
+        'emi_eligible': user_info['emi_eligible'],
+        'whatsapp_summary': user_info.get('whatsapp_summary', "No prior conversation occurred."),
+        'call_summary': user_info.get('call_summary', "No prior conversation occurred."),
+        'use_context' : False,
+    }
+
+
+def store_context(context: dict, context_dir=CONTEXT_DIR) -> str:
+    """Writes the context atomically under a content-addressed key and returns the key."""
+    payload = json.dumps(context, ensure_ascii=False, sort_keys=True, separators=(",", ":"))
+    key = hashlib.sha256(payload.encode("utf-8")).hexdigest()[:32]
+    path = os.path.join(context_dir, f"{key}.json")
+    if not os.path.exists(path):
+        os.makedirs(context_dir, exist_ok=True)
+        with tempfile.NamedTemporaryFile("w", encoding="utf-8", dir=context_dir, suffix=".tmp", delete=False) as temp_file:
+            temp_file.write(payload)
+        os.replace(temp_file.name, path)
+    else:
+        os.utime(path)          #Keeps a reused context from being pruned
+    prune_contexts(context_dir)
+    return key
+
+
+def load_context(key: str, context_dir=CONTEXT_DIR) -> dict:
+    if not context_dir:
+        raise FileNotFoundError("DISPATCH_CONTEXT_DIR is not set on this worker")
+    with open(os.path.join(context_dir, f"{os.path.basename(key)}.json"), "r", encoding="utf-8") as context_file:
+        return json.load(context_file)
+
+
+def prune_contexts(context_dir=CONTEXT_DIR):
+    """Removes contexts older than CONTEXT_TTL_SECONDS, at most once an hour."""
+    global _pruned_at
+    now = time.time()
+    if now - _pruned_at < 3600:
+        return
+    _pruned_at = now
+    for name in os.listdir(context_dir):
+        path = os.path.join(context_dir, name)
+        try:
+            if now - os.path.getmtime(path) > CONTEXT_TTL_SECONDS:
+                os.remove(path)
+        except OSError:
+            pass
+
+
+def compact_metadata(context: dict, sip_trunk_id=None) -> dict:
+    """Job metadata that references the stored context when DISPATCH_CONTEXT_DIR is set, otherwise (or if it could not be stored) carries it inline."""
+    metadata = {"v": METADATA_VERSION, "phone": context["phone"]}
+    if CONTEXT_DIR:
+        try:
+            metadata["key"] = store_context(context)
+        except OSError as e:
+            print(f"Could not store the dispatch context, sending it inline: {e}")
+    if "key" not in metadata:
+        metadata["context"] = context
+    if sip_trunk_id:
+        metadata["sip_trunk_id"] = sip_trunk_id
+    return metadata
+
+
+def resolve_context(metadata: dict) -> dict:
+    """Returns the full context for job metadata of any version; raises OSError / ValueError if a referenced context cannot be read."""
+    if "v" not in metadata:
+        return metadata
+    if "context" in metadata:
+        return metadata["context"]
+    return load_context(metadata["key"])
@@ -0,0 +1,163 @@
+# app/inflight.py
+
+import os
+import time
+import socket
+import sqlite3
+import asyncio
+import threading
+
+from blocking_io import run_blocking
+
+DEDUPE_TTL = float(os.getenv("DISPATCH_DEDUPE_TTL_SECONDS", "600"))
+DEDUPE_DB = os.getenv("DISPATCH_DEDUPE_DB")         #Set to share the registry between processes on one host
+
+SCHEMA = """
+create table if not exists inflight_dispatches (
+    phone       text primary key,
+    owner       text not null,
+    room        text,
+    expires_at  real not null
+);
+"""
+
+
+class InFlightRegistry:
+    """
+    Per-phone registry of dispatches that are in flight, so a borrower is never rung twice at once.
+
+    A request for a number that was dispatched less than DEDUPE_TTL seconds ago is coalesced onto
+    that dispatch and gets its (room_name, timings) instead of dialing again. With DEDUPE_DB the
+    claim is also recorded in SQLite, so other processes suppress their duplicates as well. A failed
+    dispatch, or a reported call outcome, releases the number straight away.
+    """
+
+    _instance = None
+
+    def __init__(self, ttl=DEDUPE_TTL, shared_path=DEDUPE_DB):
+        self.ttl = ttl
+        self.entries = {}       #phone -> (future, expires_at)
+        self.watchers = {}      #phone -> futures resolved by the next release of the number
+        self.counts = {"dispatches": 0, "coalesced": 0, "suppressed_shared": 0}
+        self.owner = f"{socket.gethostname()}:{os.getpid()}"
+        self._pruned_at = time.time()
+        self._lock = threading.Lock()
+        self._connection = None
+        if shared_path:
+            os.makedirs(os.path.dirname(os.path.abspath(shared_path)), exist_ok=True)
+            self._connection = sqlite3.connect(shared_path, check_same_thread=False, timeout=5)
+            self._connection.execute("pragma journal_mode=wal")
+            self._connection.executescript(SCHEMA)
+
+    @classmethod
+    def get(cls):
+        if cls._instance is None:
+            cls._instance = cls()
+        return cls._instance
+
+    async def run(self, phone, dispatch):
+        """Awaits `dispatch()` -> (room_name, timings) unless the number is already in flight, then shares that result."""
+        phone = str(phone)
+        now = time.time()
+        self.prune(now)
+
+        entry = self.entries.get(phone)
+        if entry is not None and entry[1] > now:
+            self.counts["coalesced"] += 1
+            return await asyncio.shield(entry[0])
+
+        #Registered before the first await, so concurrent requests in this process coalesce instead of racing the claim
+        future = asyncio.get_running_loop().create_future()
+        self.entries[phone] = (future, now + self.ttl)
+        claimed = False
+        try:
+            if self._connection is not None:
+                claimed, room = await run_blocking("db", self.claim, phone, now)
+                if not claimed:
+                    self.counts["suppressed_shared"] += 1
+                    if not room:
+                        raise Exception("A dispatch to this number is already in progress")
+                    future.set_result((room, {}))
+                    return room, {}
+
+            self.counts["dispatches"] += 1
+            result = await dispatch()
+        except BaseException as e:
+            self.entries.pop(phone, None)
+            if claimed:
+                await run_blocking("db", self.forget, phone)
+            if isinstance(e, asyncio.CancelledError):
+                #Only the owning task was cancelled; requests coalesced onto it get a normal failure they can handle
+                e = RuntimeError("The dispatch to this number was cancelled")
+            future.set_exception(e)
+            future.exception()          #Marks it retrieved when no duplicate was waiting on it
+            raise
+
+        future.set_result(result)
+        if claimed:
+            await run_blocking("db", self.record_room, phone, result[0])
+        return result
+
+    def watch_release(self, phone):
+        """A future resolved by the next release(phone), i.e. when the call's outcome arrives; register it before dialing."""
+        future = asyncio.get_running_loop().create_future()
+        self.watchers.setdefault(str(phone), []).append(future)
+        return future
+
+    def unwatch(self, phone, future):
+        watchers = self.watchers.get(str(phone), [])
+        if future in watchers:
+            watchers.remove(future)
+        if not watchers:
+            self.watchers.pop(str(phone), None)
+
+    async def release(self, phone):
+        """Forgets the number, e.g. once the call ended, so the next request dials it again."""
+        phone = str(phone)
+        self.entries.pop(phone, None)
+        for future in self.watchers.pop(phone, []):
+            if not future.done():
+                future.set_result(None)
+        if self._connection is not None:
+            await run_blocking("db", self.forget, phone)
+
+    def prune(self, now):
+        if now - self._pruned_at < 60:
+            return
+        self._pruned_at = now
+        for phone in [phone for phone, (future, expires_at) in self.entries.items() if expires_at <= now and future.done()]:
+            del self.entries[phone]
+
+    def execute(self, sql, parameters=()):
+        with self._lock, self._connection:
+            cursor = self._connection.execute(sql, parameters)
+            return cursor.rowcount, cursor.fetchall()
+
+    def claim(self, phone, now):
+        """Claims the number for this process unless another live claim exists; returns (claimed, room of the other claim)."""
+        claimed, _ = self.execute(
+            """
+            insert into inflight_dispatches (phone, owner, room, expires_at) values (?, ?, null, ?)
+            on conflict (phone) do update set owner = excluded.owner, room = null, expires_at = excluded.expires_at
+            where inflight_dispatches.expires_at <= ?
+            """,
+            (phone, self.owner, now + self.ttl, now)
+        )
+        if claimed:
+            return True, None
+        _, rows = self.execute("select room from inflight_dispatches where phone = ?", (phone,))
+        return False, rows[0][0] if rows else None
+
+    def record_room(self, phone, room):
+        self.execute("update inflight_dispatches set room = ? where phone = ? and owner = ?", (room, phone, self.owner))
+
+    def forget(self, phone):
+        self.execute("delete from inflight_dispatches where phone = ?", (phone,))
+
+    def stats(self):
+        now = time.time()
+        return {
+            **self.counts,
+            "suppressed": self.counts["coalesced"] + self.counts["suppressed_shared"],
+            "in_flight": sum(1 for _, expires_at in self.entries.values() if expires_at > now),
+        }
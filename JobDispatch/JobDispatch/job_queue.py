@@ -0,0 +1,181 @@
+# app/job_queue.py
+
+import os
+import json
+import time
+import uuid
+import sqlite3
+import asyncio
+import threading
+
+from blocking_io import run_blocking
+
+JOB_DB_PATH = os.getenv("DISPATCH_JOB_DB", os.path.join(os.path.dirname(os.path.abspath(__file__)), "cache", "dispatch_jobs.db"))
+JOB_WORKERS = int(os.getenv("DISPATCH_JOB_WORKERS", "8"))
+JOB_RETENTION_SECONDS = 3600 * float(os.getenv("DISPATCH_JOB_RETENTION_HOURS", "24"))
+PRUNE_INTERVAL_SECONDS = 3600
+
+#Stages before the agent dispatch is sent; a job interrupted in any later stage may already have rung the borrower
+REPLAYABLE_STAGES = ("queued", "started", "warm_up", "context")
+
+SCHEMA = """
+create table if not exists dispatch_jobs (
+    id           text primary key,
+    phone        text not null,
+    status       text not null,
+    stage        text not null,
+    created_at   real not null,
+    started_at   real,
+    finished_at  real,
+    result       text,
+    error        text
+);
+create index if not exists dispatch_jobs_status_created_idx on dispatch_jobs (status, created_at);
+"""
+
+
+class DispatchJobs:
+    """
+    Accepted-job model for POST /dispatch.
+
+    Jobs are written to a local SQLite queue before the request returns and are then run by a
+    pool of background workers. Jobs that were queued, or running but had not yet reached the
+    agent dispatch, when the process stopped are picked up again on the next start. A job stopped
+    at or after the dispatch is marked 'unknown' instead, so the borrower is never rung twice.
+    Each job records its stage and latency breakdown.
+    """
+
+    _instance = None
+
+    def __init__(self, path=JOB_DB_PATH, workers=JOB_WORKERS):
+        self.path = path
+        self.workers = workers
+        self.pending = asyncio.Queue()
+        self._tasks = []
+        self._pruned_at = 0.0
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection.execute("pragma journal_mode=wal")
+        self._connection.executescript(SCHEMA)
+
+    @classmethod
+    def get(cls):
+        if cls._instance is None:
+            cls._instance = cls()
+        return cls._instance
+
+    def execute(self, sql, parameters=()):
+        with self._lock, self._connection:
+            return self._connection.execute(sql, parameters).fetchall()
+
+    async def start(self, run_job):
+        """
+        Starts the workers; `run_job(phone, on_stage)` does the dispatch and returns a JSON-serializable result.
+        Unfinished jobs from a previous run that had not reached the dispatch are queued again, oldest first.
+        """
+        await self.prune()
+        stages = ", ".join("?" for _ in REPLAYABLE_STAGES)
+        await run_blocking(
+            "db", self.execute,
+            f"""
+            update dispatch_jobs set status = 'unknown', finished_at = ?,
+                error = 'Interrupted by a restart after the dispatch may have been sent; not retried'
+            where status = 'running' and stage not in ({stages})
+            """,
+            (time.time(), *REPLAYABLE_STAGES)
+        )
+        rows = await run_blocking(
+            "db", self.execute,
+            f"select id, phone from dispatch_jobs where status in ('queued', 'running') and stage in ({stages}) order by created_at",
+            REPLAYABLE_STAGES
+        )
+        for job_id, phone in rows:
+            self.pending.put_nowait((job_id, phone))
+        if rows:
+            print(f"Recovered {len(rows)} unfinished dispatch jobs.")
+
+        self._tasks = [asyncio.create_task(self._worker(run_job)) for _ in range(self.workers)]
+        return self
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    async def submit(self, phone):
+        job = {"id": uuid.uuid4().hex, "phone": str(phone), "status": "queued", "stage": "queued", "created_at": time.time()}
+        await run_blocking(
+            "db", self.execute,
+            "insert into dispatch_jobs (id, phone, status, stage, created_at) values (?, ?, ?, ?, ?)",
+            (job["id"], job["phone"], job["status"], job["stage"], job["created_at"])
+        )
+        self.pending.put_nowait((job["id"], job["phone"]))
+        return job
+
+    async def status(self, job_id):
+        rows = await run_blocking(
+            "db", self.execute,
+            "select id, phone, status, stage, created_at, started_at, finished_at, result, error from dispatch_jobs where id = ?",
+            (job_id,)
+        )
+        if not rows:
+            return None
+
+        job_id, phone, status, stage, created_at, started_at, finished_at, result, error = rows[0]
+        result = json.loads(result) if result else None
+        latency = {}
+        if started_at is not None:
+            latency["queue_wait"] = round(started_at - created_at, 3)
+        if result and "timings" in result:
+            latency.update(result["timings"])
+        if finished_at is not None:
+            latency["end_to_end"] = round(finished_at - created_at, 3)
+        return {
+            "id": job_id,
+            "phone": phone,
+            "status": status,
+            "stage": stage,
+            "created_at": created_at,
+            "started_at": started_at,
+            "finished_at": finished_at,
+            "latency": latency,
+            "result": result,
+            "error": error,
+        }
+
+    async def prune(self):
+        """Deletes jobs finished more than JOB_RETENTION_SECONDS ago, at most once per PRUNE_INTERVAL_SECONDS."""
+        now = time.time()
+        if now - self._pruned_at < PRUNE_INTERVAL_SECONDS:
+            return
+        self._pruned_at = now
+        await run_blocking("db", self.execute, "delete from dispatch_jobs where finished_at < ?", (now - JOB_RETENTION_SECONDS,))
+
+    async def _set_stage(self, job_id, stage):
+        await run_blocking("db", self.execute, "update dispatch_jobs set stage = ? where id = ?", (stage, job_id))
+
+    async def _worker(self, run_job):
+        while True:
+            job_id, phone = await self.pending.get()
+            await self.prune()
+            await run_blocking(
+                "db", self.execute,
+                "update dispatch_jobs set status = 'running', stage = 'started', started_at = ? where id = ?",
+                (time.time(), job_id)
+            )
+            try:
+                result = await run_job(phone, on_stage=lambda stage: self._set_stage(job_id, stage))
+                await run_blocking(
+                    "db", self.execute,
+                    "update dispatch_jobs set status = 'done', stage = 'done', finished_at = ?, result = ? where id = ?",
+                    (time.time(), json.dumps(result), job_id)
+                )
+            except asyncio.CancelledError:
+                raise           #Left as running, so the next start picks it up again
+            except Exception as e:
+                await run_blocking(
+                    "db", self.execute,
+                    "update dispatch_jobs set status = 'failed', finished_at = ?, error = ? where id = ?",
+                    (time.time(), str(e), job_id)
+                )
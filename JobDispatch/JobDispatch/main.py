@@ -1,24 +1,149 @@
 # app/main.py
 
+import json
+from contextlib import asynccontextmanager
+from datetime import date
+from typing import List, Literal, Optional
 from fastapi import FastAPI, HTTPException
-from pydantic import BaseModel
+from fastapi.responses import JSONResponse, StreamingResponse
+from pydantic import BaseModel, Field
 import asyncio
-from dispatch import create_explicit_dispatch
+from dispatch import create_explicit_dispatch, create_batch_dispatch, scheduled_dispatch, ready_superagent, start_warm_up, WarmState, LiveKitClient
+from scheduler import CampaignScheduler
+from job_queue import DispatchJobs
+from inflight import InFlightRegistry
+from context_manager import create_database
+from blocking_io import run_blocking
 
-app = FastAPI()
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Warm up in the background so the app can answer /ready while the borrower file loads
+    warm_up = start_warm_up()
+    scheduler = CampaignScheduler.get(scheduled_dispatch).start()
+    jobs = await DispatchJobs.get().start(create_explicit_dispatch)
+    yield
+    await jobs.stop()
+    await scheduler.stop()
+    warm_up.cancel()
+    await LiveKitClient.aclose()
+    await create_database().aclose()
+
+app = FastAPI(lifespan=lifespan)
 
 class DispatchRequest(BaseModel):
     customer_phone: str
 
+class BorrowerFilter(BaseModel):
+    min_pending_days: Optional[int] = None
+    max_pending_days: Optional[int] = None
+    min_late_payments: Optional[int] = None
+    loan_types: Optional[List[str]] = None
+    due_before: Optional[date] = None
+    limit: Optional[int] = Field(default=None, gt=0)
+
+class BatchDispatchRequest(BaseModel):
+    customer_phones: Optional[List[str]] = None
+    filter: Optional[BorrowerFilter] = None
+    concurrency: Optional[int] = Field(default=None, gt=0)
+
+class ScheduleRequest(BaseModel):
+    customer_phones: Optional[List[str]] = None
+    filter: Optional[BorrowerFilter] = None
+
+class CallOutcome(BaseModel):
+    customer_phone: str
+    outcome: Literal["answered", "completed", "busy", "no_answer", "failed"]
+    room: Optional[str] = None
+    sip_status_code: Optional[str] = None
+
 @app.get("/")
 def read_root():
     return {"Hello": "World"}
+
+@app.get("/ready")
+def readiness():
+    status = WarmState.status()
+    return JSONResponse(status, status_code=200 if status["ready"] else 503)
+
+@app.get("/metrics/database")
+def database_metrics():
+    return create_database().pool_stats()
+
+@app.get("/metrics/dedupe")
+def dedupe_metrics():
+    return InFlightRegistry.get().stats()
+
+@app.get("/metrics/router")
+def router_metrics():
+    if WarmState.superagent is None:
+        return {}
+    return WarmState.superagent.router.stats()
     
-@app.post("/dispatch")
+@app.post("/dispatch", status_code=202)
 async def create_dispatch(request: DispatchRequest):
+    """Queues the dispatch and returns at once; poll GET /dispatch/{job_id} for its stage and latency."""
+    try:
+        job = await DispatchJobs.get().submit(request.customer_phone)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+    return {
+        "message": "Dispatch accepted",
+        "job_id": job["id"],
+        "status_url": f"/dispatch/{job['id']}"
+    }
+
+@app.get("/dispatch/{job_id}")
+async def dispatch_status(job_id: str):
+    job = await DispatchJobs.get().status(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Dispatch job not found")
+    return job
+
+@app.post("/dispatch/batch")
+async def create_dispatch_batch(request: BatchDispatchRequest):
+    """Streams one JSON line per number ({"phone", "status", ...}) as each dispatch completes."""
+    if request.customer_phones is None and request.filter is None:
+        raise HTTPException(status_code=422, detail="Provide customer_phones or a filter")
+
+    try:
+        # Waiting for the warm-up here means a cold service fails the request instead of the stream
+        superagent = await ready_superagent()
+        phones = request.customer_phones
+        if phones is None:
+            phones = await run_blocking("parse", superagent.file.select_phones, **request.filter.model_dump(exclude_none=True))
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+    async def results():
+        async for result in create_batch_dispatch(phones, concurrency=request.concurrency):
+            yield json.dumps(result) + "\n"
+
+    return StreamingResponse(results(), media_type="application/x-ndjson")
+
+@app.post("/schedule")
+async def schedule_calls(request: ScheduleRequest):
+    """Queues borrowers in the campaign scheduler, which dials them by priority inside the calling window."""
+    if request.customer_phones is None and request.filter is None:
+        raise HTTPException(status_code=422, detail="Provide customer_phones or a filter")
+
     try:
-        result = await create_explicit_dispatch(request.customer_phone)
-        return result
+        superagent = await ready_superagent()
+        phones = request.customer_phones
+        if phones is None:
+            phones = await run_blocking("parse", superagent.file.select_phones, **request.filter.model_dump(exclude_none=True))
+        queued, missing = await CampaignScheduler.get().enqueue(phones)
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
+    return {"queued": queued, "missing": missing}
+
+@app.get("/schedule")
+def schedule_status():
+    return CampaignScheduler.get().status()
 
+@app.post("/dispatch/outcome")
+async def report_call_outcome(outcome: CallOutcome):
+    """Called by the voice worker when a scheduled call is answered, ends, or fails to connect."""
+    CampaignScheduler.get().report_outcome(outcome.customer_phone, outcome.outcome, room=outcome.room)
+    if outcome.outcome != "answered":
+        await InFlightRegistry.get().release(outcome.customer_phone)
+    return {"message": "Outcome recorded"}
@@ -0,0 +1,257 @@
+# app/scheduler.py
+
+import os
+import time
+import heapq
+import asyncio
+import datetime
+import itertools
+
+import pytz
+import pandas as pd
+
+from context_manager import BorrowerStore
+from blocking_io import run_blocking
+
+IST = pytz.timezone("Asia/Kolkata")
+
+#Borrowers may only be called inside this IST window (the RBI fair practices code allows 08:00-19:00)
+WINDOW_START = datetime.time.fromisoformat(os.getenv("SCHEDULER_WINDOW_START", "08:00"))
+WINDOW_END = datetime.time.fromisoformat(os.getenv("SCHEDULER_WINDOW_END", "19:00"))
+
+POOL_CAPACITY = int(os.getenv("SCHEDULER_POOL_CAPACITY", "20"))
+SLOT_SECONDS = float(os.getenv("SCHEDULER_SLOT_SECONDS", "600"))
+MAX_ATTEMPTS = int(os.getenv("SCHEDULER_MAX_ATTEMPTS", "3"))
+RETRY_DELAYS = {
+    "busy": 60 * float(os.getenv("SCHEDULER_BUSY_RETRY_MINUTES", "15")),
+    "no_answer": 60 * float(os.getenv("SCHEDULER_NO_ANSWER_RETRY_MINUTES", "60")),
+    "failed": 60 * float(os.getenv("SCHEDULER_FAILED_RETRY_MINUTES", "5")),
+}
+
+#Priority = weighted sum of the borrower's collection fields; higher is called first
+PENDING_DAYS_WEIGHT = 1.0
+LATE_PAYMENT_WEIGHT = 5.0
+MINIMUM_DUE_WEIGHT = 0.01
+DUE_SOON_DAYS = 3
+DUE_SOON_BONUS = 10.0
+
+
+def parse_trunks(spec):
+    """"trunk_a:10,trunk_b:5" -> {"trunk_a": 10, "trunk_b": 5}; without a spec, SIP_TRUNK_ID gets SCHEDULER_TRUNK_CAPACITY."""
+    if not spec:
+        return {os.getenv("SIP_TRUNK_ID") or "default": int(os.getenv("SCHEDULER_TRUNK_CAPACITY", "10"))}
+    trunks = {}
+    for item in spec.split(","):
+        trunk_id, _, capacity = item.strip().rpartition(":")
+        trunks[trunk_id] = int(capacity)
+    return trunks
+
+
+def priority_scores(fields: pd.DataFrame, today=None) -> pd.Series:
+    """Vectorized call priority from Pending_days, No_of_late_payments, Minimum_amount_due and Next_due_date."""
+    if fields.empty:
+        return pd.Series(dtype='float64')
+    today = pd.Timestamp(today or datetime.datetime.now(IST).date())
+    days_to_due = (fields['Next_due_date'] - today).dt.days
+    due_soon = days_to_due.between(0, DUE_SOON_DAYS)
+    return (
+        PENDING_DAYS_WEIGHT * fields['Pending_days'].astype('float64')
+        + LATE_PAYMENT_WEIGHT * fields['No_of_late_payments'].astype('float64')
+        + MINIMUM_DUE_WEIGHT * fields['Minimum_amount_due'].astype('float64')
+        + DUE_SOON_BONUS * due_soon.astype('float64')
+    )
+
+
+def next_window_open(now: datetime.datetime) -> datetime.datetime:
+    """`now` if it is inside the calling window, otherwise the start of the next one (both in IST)."""
+    now = now.astimezone(IST)
+    if now.time() < WINDOW_START:
+        return IST.localize(datetime.datetime.combine(now.date(), WINDOW_START))
+    if now.time() >= WINDOW_END:
+        return IST.localize(datetime.datetime.combine(now.date() + datetime.timedelta(days=1), WINDOW_START))
+    return now
+
+
+class CampaignScheduler:
+    """
+    Paces campaign dispatches to the capacity of the SIP trunks and the agent worker pool.
+
+    Borrowers wait in a timer heap ordered by when they may next be called; once that time has come
+    they move to a heap ordered by priority score, which decides who is dialed next. A number is
+    only dispatched inside the IST calling window and while both its trunk
+    and the worker pool have a free call slot. Outcomes reported by the voice worker release the slot
+    and put busy / unanswered numbers back in the queue after a delay, up to MAX_ATTEMPTS calls.
+    A slot whose outcome never arrives is released after SLOT_SECONDS.
+    """
+
+    _instance = None
+
+    def __init__(self, dispatch_fnc, trunks=None, pool_capacity=POOL_CAPACITY):
+        self.dispatch_fnc = dispatch_fnc        #async (phone, sip_trunk_id) -> room name
+        self.trunks = trunks or parse_trunks(os.getenv("SCHEDULER_TRUNKS"))
+        self.pool_capacity = pool_capacity
+        self.waiting = []       #(not_before, seq, phone), for numbers that may not be called yet
+        self.eligible = []      #(-priority, seq, phone), for numbers that may be called now
+        self.queued = {}        #phone -> priority, for numbers waiting in the queue
+        self.attempts = {}
+        self.priorities = {}
+        self.active = {}        #phone -> {"trunk", "room", "started"}
+        self.counts = {"dispatched": 0, "answered": 0, "completed": 0, "busy": 0, "no_answer": 0,
+                       "failed": 0, "rescheduled": 0, "exhausted": 0, "expired": 0}
+        self._sequence = itertools.count()
+        self._wake = asyncio.Event()
+        self._task = None
+
+    @classmethod
+    def get(cls, dispatch_fnc=None):
+        if cls._instance is None:
+            cls._instance = cls(dispatch_fnc)
+        return cls._instance
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+        return self
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+
+    async def enqueue(self, phone_numbers):
+        """Queues borrowers by priority; returns (queued, missing). Numbers already queued or on a call are skipped."""
+        phone_numbers = [phone for phone in dict.fromkeys(str(phone) for phone in phone_numbers)
+                         if phone not in self.queued and phone not in self.active]
+        fields = await run_blocking("parse", BorrowerStore.get().priority_fields, phone_numbers)
+        scores = priority_scores(fields)
+
+        now = time.time()
+        for phone, score in scores.items():
+            self.push(phone, float(score), now)
+        self._wake.set()
+        return len(scores), [phone for phone in phone_numbers if phone not in scores.index]
+
+    def push(self, phone, priority, not_before):
+        self.queued[phone] = priority
+        if not_before <= time.time():
+            heapq.heappush(self.eligible, (-priority, next(self._sequence), phone))
+        else:
+            heapq.heappush(self.waiting, (not_before, next(self._sequence), phone))
+
+    def promote_due(self):
+        """Moves the numbers whose retry time has come into the priority heap."""
+        now = time.time()
+        while self.waiting and self.waiting[0][0] <= now:
+            _, sequence, phone = heapq.heappop(self.waiting)
+            heapq.heappush(self.eligible, (-self.queued[phone], sequence, phone))
+
+    def report_outcome(self, phone, outcome, room=None):
+        """
+        Records a call outcome from the voice worker: "answered" keeps the slot, "completed" releases it,
+        and "busy" / "no_answer" / "failed" release it and reschedule the number.
+        """
+        phone = str(phone)
+        if outcome == "answered":
+            self.counts["answered"] += 1
+            return
+        call = self.active.pop(phone, None)
+        if call is None or (room and call["room"] and call["room"] != room):
+            if call is not None:
+                self.active[phone] = call       #Outcome of an older call to the same number
+            return
+        self.counts[outcome] = self.counts.get(outcome, 0) + 1
+        if outcome in RETRY_DELAYS:
+            self.reschedule(phone, outcome)
+        else:
+            self.forget(phone)
+        self._wake.set()
+
+    def reschedule(self, phone, outcome):
+        if self.attempts.get(phone, 0) >= MAX_ATTEMPTS:
+            self.counts["exhausted"] += 1
+            self.forget(phone)
+            return
+        self.counts["rescheduled"] += 1
+        self.push(phone, self.priorities.get(phone, 0.0), time.time() + RETRY_DELAYS[outcome])
+
+    def free_trunk(self):
+        """The trunk with the most free call slots, or None when every trunk or the worker pool is full."""
+        if len(self.active) >= self.pool_capacity:
+            return None
+        load = {trunk: 0 for trunk in self.trunks}
+        for call in self.active.values():
+            load[call["trunk"]] = load.get(call["trunk"], 0) + 1
+        trunk = max(self.trunks, key=lambda trunk: self.trunks[trunk] - load[trunk])
+        return trunk if load[trunk] < self.trunks[trunk] else None
+
+    def expire_slots(self):
+        cutoff = time.time() - SLOT_SECONDS
+        for phone in [phone for phone, call in self.active.items() if call["started"] < cutoff]:
+            del self.active[phone]
+            self.counts["expired"] += 1
+            self.forget(phone)
+
+    def forget(self, phone):
+        """Drops the attempt count and priority of a number that left the campaign, so a later campaign starts it afresh."""
+        self.attempts.pop(phone, None)
+        self.priorities.pop(phone, None)
+
+    async def _sleep(self, seconds):
+        try:
+            await asyncio.wait_for(self._wake.wait(), timeout=max(seconds, 0.0))
+        except asyncio.TimeoutError:
+            pass
+
+    async def _run(self):
+        while True:
+            self._wake.clear()
+            self.expire_slots()
+
+            now = datetime.datetime.now(IST)
+            window_open = next_window_open(now)
+            if window_open > now:
+                await self._sleep((window_open - now).total_seconds())
+                continue
+
+            self.promote_due()
+            if not self.eligible:
+                await self._sleep(self.waiting[0][0] - time.time() if self.waiting else SLOT_SECONDS)
+                continue
+
+            trunk = self.free_trunk()
+            if trunk is None:
+                #Woken up by an outcome releasing a slot, or re-checked when the oldest slot expires
+                oldest = min(call["started"] for call in self.active.values())
+                await self._sleep(oldest + SLOT_SECONDS - time.time())
+                continue
+
+            _, _, phone = heapq.heappop(self.eligible)
+            self.priorities[phone] = self.queued.pop(phone, 0.0)
+            self.attempts[phone] = self.attempts.get(phone, 0) + 1
+            self.active[phone] = {"trunk": trunk, "room": None, "started": time.time()}
+            self.counts["dispatched"] += 1
+            asyncio.create_task(self._dispatch(phone, trunk))
+
+    async def _dispatch(self, phone, trunk):
+        try:
+            room = await self.dispatch_fnc(phone, None if trunk == "default" else trunk)
+            if phone in self.active:
+                self.active[phone]["room"] = room
+        except Exception as e:
+            print(f"Scheduled dispatch to {phone} failed: {e}")
+            self.report_outcome(phone, "failed")
+
+    def status(self):
+        now = datetime.datetime.now(IST)
+        load = {trunk: 0 for trunk in self.trunks}
+        for call in self.active.values():
+            load[call["trunk"]] = load.get(call["trunk"], 0) + 1
+        return {
+            "in_calling_window": next_window_open(now) <= now,
+            "queued": len(self.queued),
+            "due_now": len(self.eligible) + sum(1 for entry in self.waiting if entry[0] <= time.time()),
+            "active_calls": len(self.active),
+            "pool_capacity": self.pool_capacity,
+            "trunks": {trunk: {"active": load[trunk], "capacity": capacity} for trunk, capacity in self.trunks.items()},
+            "counts": dict(self.counts),
+        }
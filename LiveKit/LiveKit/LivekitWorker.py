@@ -7,6 +7,7 @@ logger = logging.getLogger("voice-agent")
 logger.setLevel(logging.INFO)
 
 import json
+import time
 import datetime, pytz
 import asyncio
 import os
@@ -14,8 +15,11 @@ from dotenv import load_dotenv
 load_dotenv(override=True)
 
 # Custom made Libraries________________________________________
-from context_manager import UserData, Database
-from LogMetrics import serialize_metrics, save_to_file
+from context_manager import BorrowerStore, create_database
+from LogMetrics import serialize_metrics, save_to_file, LoopLagMonitor, CallTimeline
+from blocking_io import run_blocking
+from transcript_journal import TranscriptJournal
+from dispatch_context import build_context, resolve_context
 
 # Livekit Agent Libraries______________________________________
 from livekit import agents, api
@@ -23,10 +27,13 @@ from livekit.agents import llm, metrics, function_tool, get_job_context
 
 from livekit.agents import (
     AgentSession,
+    AgentStateChangedEvent,
     Agent,
     ChatMessage,
     ChatContext,
+    ConversationItemAddedEvent,
     JobContext,
+    JobProcess,
     MetricsCollectedEvent,
     RunContext,
     WorkerOptions
@@ -51,6 +58,7 @@ from livekit.plugins import (
 from livekit.plugins.elevenlabs import VoiceSettings
 from LogMetrics import upload_file_to_blob
 import aiofiles
+import aiohttp
 
 
 #_________________________________________Defining the Environment Variables______________________________________
@@ -67,18 +75,192 @@ AZURE_OPENAI_API_KEY = os.getenv("AZURE_OPENAI_API_KEY")
 AZURE_OPENAI_ENDPOINT = os.getenv("AZURE_OPENAI_ENDPOINT")
 OPENAI_API_VERSION = os.getenv("OPENAI_API_VERSION")
 SIP_TRUNK_ID = os.getenv("SIP_TRUNK_ID")
+DISPATCH_OUTCOME_URL = os.getenv("DISPATCH_OUTCOME_URL")       #JobDispatch's /dispatch/outcome, for the campaign scheduler
+
+PREWARM_PLUGINS = os.getenv("VOICE_PREWARM", "true").lower() != "false"      #"false" builds the plugins per call, to compare latencies
+
+LLM_WARM_UP_TIMEOUT = float(os.getenv("LLM_WARM_UP_TIMEOUT_SECONDS", "5"))
+
+BUSY_SIP_CODES = {"486", "600", "603"}
+NO_ANSWER_SIP_CODES = {"408", "480", "487"}
+
+
+def create_plugins():
+    """The STT, LLM, TTS clients and the VAD model used by a call."""
+    return {
+        'stt': deepgram.STT(
+            model="nova-3",
+            smart_format=True,
+            filler_words=True,
+            language="multi",
+            api_key=DEEPGRAM_API_KEY
+        ),
+        'llm': llm.FallbackAdapter([
+            openai.LLM.with_azure(
+                azure_endpoint=AZURE_OPENAI_ENDPOINT,
+                api_key=AZURE_OPENAI_API_KEY,
+                api_version=OPENAI_API_VERSION
+            ),
+            groq.LLM(
+                model='llama3-70b-8192',
+                api_key=GROQ_API_KEY
+            ),
+        ]),
+        'tts': elevenlabs.TTS(
+            voice_id="JNaMjd7t4u3EhgkVknn3",
+            model="eleven_turbo_v2_5",
+            voice_settings=VoiceSettings(
+                speed=1.1,
+                style=0,
+                stability=0.5,
+                use_speaker_boost=False,
+                similarity_boost=0.8
+            ),
+            api_key=ELEVENLABS_API_KEY
+        ),
+        'vad': silero.VAD.load(),
+    }
+
+
+def prewarm(proc: JobProcess):
+    """
+    Runs in every idle worker process before it is handed a job, so the job itself starts with the VAD model
+    loaded, the plugin clients built and the borrower data loading.
+    """
+    started = time.perf_counter()
+    if PREWARM_PLUGINS:
+        proc.userdata['plugins'] = create_plugins()
+    BorrowerStore.get().start()
+    proc.userdata['prewarm_seconds'] = round(time.perf_counter() - started, 3)
+    logger.info(f"Worker process prewarmed in {proc.userdata['prewarm_seconds']}s")
+
+
+async def warm_up(plugins, timeline):
+    """
+    Primes the LLM connection while the phone rings, so the first generated turn does not pay for it.
+
+    The STT websocket needs nothing here: session.start runs during ringing and already opens the session's
+    own Deepgram stream. On the pinned plugin versions neither Deepgram nor ElevenLabs implements prewarm()
+    (the TTS one is the base no-op), so the opening line's TTS connection is paid by SpeculativeUtterance
+    during ringing instead; prewarm() is still called for plugin versions that do implement it. The LLM has
+    no prewarm() either, so its HTTP connection is primed with a model list request on the primary client.
+    """
+    for name in ('stt', 'tts', 'llm'):
+        prewarm_fnc = getattr(plugins[name], 'prewarm', None)
+        if callable(prewarm_fnc):
+            try:
+                prewarm_fnc()
+            except Exception as e:
+                logger.warning(f"Could not prewarm the {name} connection: {e}")
+
+    if not callable(getattr(plugins['llm'], 'prewarm', None)):
+        primary = getattr(plugins['llm'], '_llm_instances', [plugins['llm']])[0]
+        client = getattr(primary, '_client', None)
+        if client is not None:
+            try:
+                await asyncio.wait_for(client.models.list(), LLM_WARM_UP_TIMEOUT)
+            except Exception as e:
+                logger.warning(f"Could not prime the LLM connection: {e!r}")
+    timeline.mark('llm_warmed_up')
+
+
+async def abandon_warm_up(warm_up_task, plugins):
+    """Stops the warm-up of an unanswered call and closes the connections it opened."""
+    warm_up_task.cancel()
+    await asyncio.gather(warm_up_task, return_exceptions=True)
+    for name in ('stt', 'tts', 'llm'):
+        try:
+            await plugins[name].aclose()
+        except Exception as e:
+            logger.warning(f"Could not close the {name} connection: {e}")
+
+
+def opening_line(context):
+    """
+    The scripted first utterance: greeting and identity confirmation only. The payment reminder is not part
+    of it, since nothing about the account may be said before the borrower has confirmed who they are.
+    """
+    return f"नमस्ते, मैं One Card से बात कर रही हूँ। क्या मेरी बात {context['first_name']} {context['last_name']} जी से हो रही है?"
+
+
+class SpeculativeUtterance:
+    """
+    Synthesizes a scripted utterance with the call's TTS while the phone rings and buffers the audio frames,
+    so session.say() can play it the instant the borrower picks up. Playback may start before the synthesis
+    has finished; the remaining frames are streamed as they arrive. say() is only called once the first
+    frame exists, since even an interrupted say() adds its text to the chat context as spoken.
+    """
+
+    def __init__(self, tts, text, timeline):
+        self.text = text
+        self.timeline = timeline
+        self.frames = asyncio.Queue()
+        self.error = None
+        self._task = asyncio.create_task(self._render(tts))
+
+    async def _render(self, tts):
+        try:
+            async with tts.synthesize(self.text) as stream:
+                async for audio in stream:
+                    self.frames.put_nowait(audio.frame)
+            self.timeline.mark('opening_rendered')
+        except Exception as e:
+            logger.warning(f"Could not render the opening line ahead of the answer: {e}")
+            self.error = e
+        finally:
+            self.frames.put_nowait(None)
+
+    async def first_frame(self):
+        """Waits for the first rendered frame; None when the synthesis ended without producing any audio."""
+        return await self.frames.get()
+
+    async def audio(self, first_frame):
+        frame = first_frame
+        while frame is not None:
+            yield frame
+            frame = await self.frames.get()
+
+    async def discard(self):
+        """Drops the rendered audio, e.g. when the call was not answered."""
+        self._task.cancel()
+        await asyncio.gather(self._task, return_exceptions=True)
+        self.frames = asyncio.Queue()
+
+
+async def borrower_context(phone):
+    """Rebuilds the call context from this worker's BorrowerStore, without conversation summaries."""
+    store = BorrowerStore.get().start()
+    if not store.ready.is_set():
+        await run_blocking("blob", store.wait_ready, 10)
+    user_info = store.fetch_user(phone[3:])
+    if 'Error' in user_info:
+        raise Exception(user_info['Error'])
+    return build_context(phone[3:], user_info)
+
+
+async def report_call_outcome(phone, room, outcome, sip_status_code=None):
+    """Tells the campaign scheduler how the call went so it can free the trunk slot and retry busy / unanswered numbers."""
+    if not DISPATCH_OUTCOME_URL:
+        return
+    payload = {"customer_phone": phone, "room": room, "outcome": outcome, "sip_status_code": sip_status_code}
+    try:
+        async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=5)) as http:
+            async with http.post(DISPATCH_OUTCOME_URL, json=payload) as response:
+                response.raise_for_status()
+    except Exception as e:
+        logger.error(f"Could not report call outcome '{outcome}' for {room}: {e}")
 
 
 #_________________________________________This class defines the Voice Agent_______________________________________
 
 class VoiceAgent(Agent):
-    def __init__(self, metadata, chat_ctx: ChatContext) -> None:
+    def __init__(self, metadata, chat_ctx: ChatContext, plugins: dict) -> None:
         self.context = metadata
         self.customer_phone = self.context['phone'][3:]
 
         due_date = self.context['due_date']
         pending_days = self.context['pending_days']
-        outstanding_amount = self.context['outstanding_amount']
+        outstanding_amount = self.context['balance_to_pay']
         minimum_due_amount = self.context['minimum_due_amount']
         late_fees = self.context['late_fees']
         interest_rate = self.context['interest_rate']
@@ -227,37 +409,10 @@ class VoiceAgent(Agent):
             - How can I make payment? → "You can make the payment through app."
             """,
 
-            stt=deepgram.STT(
-                model="nova-3",
-                smart_format=True,
-                filler_words=True,
-                language="multi",
-                api_key=DEEPGRAM_API_KEY
-            ),
-            llm=llm.FallbackAdapter([
-                openai.LLM.with_azure(
-                    azure_endpoint=AZURE_OPENAI_ENDPOINT,
-                    api_key=AZURE_OPENAI_API_KEY,
-                    api_version=OPENAI_API_VERSION
-                ),
-                groq.LLM(
-                    model='llama3-70b-8192',
-                    api_key=GROQ_API_KEY
-                ),
-            ]),
-            tts=elevenlabs.TTS(
-                voice_id="JNaMjd7t4u3EhgkVknn3",
-                model="eleven_turbo_v2_5",
-                voice_settings=VoiceSettings(
-                    speed=1.1,
-                    style=0,
-                    stability=0.5,
-                    use_speaker_boost=False,
-                    similarity_boost=0.8
-                ),
-                api_key=ELEVENLABS_API_KEY
-            ),
-            vad=silero.VAD.load(),
+            stt=plugins['stt'],
+            llm=plugins['llm'],
+            tts=plugins['tts'],
+            vad=plugins['vad'],
             turn_detection='stt',
         )
 
@@ -317,11 +472,12 @@ class VoiceAgent(Agent):
         """
         phone_number=self.customer_phone
 
-        #Write code to fetch all user details from any database server based on phone number.
+        #Borrower details come from the process-wide store; only the very first call of a fresh worker waits for the load.
+        store = BorrowerStore.get()
+        if not store.ready.is_set():
+            await run_blocking("blob", store.wait_ready, 10)
 
-        data = UserData()
-        data.read_file('borrower.csv')
-        user_data = data.fetch_user(phone_number)
+        user_data = store.fetch_user(phone_number)
         return user_data
 
 
@@ -356,20 +512,39 @@ async def entrypoint(ctx: JobContext):
         'EOU_METRICS' : []
     }
 
-    #Extracting Metadata
-    metadata = json.loads(ctx.job.metadata)
+    timeline = CallTimeline()       #Call milestones for the per-call latency report
+    plugins = ctx.proc.userdata.get('plugins')
+    prewarmed = plugins is not None
+    if not prewarmed:
+        plugins = create_plugins()
+
+    lag_monitor = LoopLagMonitor()       #Tracks how long the audio event loop is blocked during this session
+    lag_monitor.start()
 
-    first_name = metadata['first_name']
-    last_name = metadata['last_name']
-    outstanding_amount = metadata['outstanding_amount']
-    installment = metadata['installment']
-    wa_summary = metadata['whatsapp_summary']
-    call_summary = metadata['call_summary']
+    BorrowerStore.get().start()         #Already loading if the process was prewarmed
+    replay_task = asyncio.create_task(TranscriptJournal.replay())      #Stores transcripts left behind by a crashed worker
 
-    phone = metadata['phone']  # Ex. +91987654321
+    #Extracting Metadata; the full context comes inline, or by reference when DISPATCH_CONTEXT_DIR is a shared volume
+    metadata = json.loads(ctx.job.metadata)
+    try:
+        context = resolve_context(metadata)
+    except (OSError, ValueError) as e:
+        logger.warning(f"Could not read dispatch context {metadata.get('key')}, rebuilding it: {e}")
+        context = await borrower_context(metadata['phone'])
+
+    first_name = context['first_name']
+    last_name = context['last_name']
+    outstanding_amount = context['balance_to_pay']
+    installment = context['installment']
+    wa_summary = context['whatsapp_summary']
+    call_summary = context['call_summary']
+
+    phone = context['phone']  # Ex. +91987654321
+    sip_trunk_id = metadata.get('sip_trunk_id') or SIP_TRUNK_ID
+    call_answered = False
     customer = f'{first_name} {last_name}'
 
-    previous_context_flag = metadata['use_context']
+    previous_context_flag = context['use_context']
 
     #--------------Context Management- Provide previous conversation context to Agent
     initial_context = f"""
@@ -395,7 +570,7 @@ async def entrypoint(ctx: JobContext):
     )
 
 
-    agent = VoiceAgent(metadata=metadata,chat_ctx=initial_ctx)      #Initializing Worker Agent
+    agent = VoiceAgent(metadata=context,chat_ctx=initial_ctx,plugins=plugins)      #Initializing Worker Agent
 
     await ctx.connect()         #Connects the Voice Agent to Livekit Room
 
@@ -408,6 +583,25 @@ async def entrypoint(ctx: JobContext):
         allow_interruptions=True
     )
 
+    #--------------Journal each turn as it happens; a background task ships them to the Database-----------------
+    journal = TranscriptJournal(room_name=ctx.room.name, phone=phone[3:], name=customer)
+    journal.start()
+
+    @session.on("conversation_item_added")
+    def _on_conversation_item_added(ev: ConversationItemAddedEvent):
+        item = ev.item
+        if item.type == 'message' and item.role in ('user', 'assistant') and item.text_content:
+            journal.append(
+                speaker='agent' if item.role == 'assistant' else customer,
+                text=item.text_content
+            )
+
+    @session.on("agent_state_changed")
+    def _on_agent_state_changed(ev: AgentStateChangedEvent):
+        if ev.new_state == 'speaking' and 'first_agent_audio' not in timeline.marks:
+            timeline.mark('first_agent_audio')
+            logger.info(f"Answer to first agent audio for {ctx.room.name}: {timeline.seconds('answered', 'first_agent_audio')}s")
+
     #--------------Collect Call Metrics after each response-----------------
     @session.on("metrics_collected")
     def _on_metrics_collected(ev: MetricsCollectedEvent):
@@ -430,28 +624,34 @@ async def entrypoint(ctx: JobContext):
     #----------------------These function will be executed after the call ends and session disolves--------------
     async def store_history():
         print("\nStoring Conversation")
-        chat_history = session.history.to_dict()
-
-        phone_ref = phone[3:]
-        name = customer
-        history = []
-        db = Database()
-        ref = db.init_user(phone=phone_ref, name=name)
-
-        for chat in chat_history['items']:
-            payload = db.payload(
-                name='agent' if chat['role'] == 'assistant' else name,
-                text=chat['content'][0],  # or chat['content'] if it's a string
-                time=datetime.datetime.now().isoformat(),
-            )
-            history.append(payload)
-
-        db.add_convo(ref=ref, agent='voice',msg=history)
+        await session.aclose()      #Closing the session can still add conversation items, so it goes before the journal
+        await journal.close()       #Earlier turns are already stored, so this only flushes the tail
+        if call_answered:
+            await report_call_outcome(phone[3:], ctx.room.name, "completed")
 
 
     async def store_metrics():
         try:
             print("\nStoring Metrics\n")
+            lag_monitor.stop()
+            Metrics['EVENT_LOOP_LAG'] = lag_monitor.summary()
+            logger.info(f"Event loop lag for {ctx.room.name}: {Metrics['EVENT_LOOP_LAG']}")
+            Metrics['DATABASE_POOL'] = create_database().pool_stats()
+            Metrics['CALL_LATENCY'] = {
+                'prewarmed': prewarmed,
+                'prewarm_seconds': ctx.proc.userdata.get('prewarm_seconds'),
+                **timeline.summary(
+                    setup=('job_started', 'session_started'),
+                    ringing=('dialing', 'answered'),
+                    llm_warm_up=('dialing', 'llm_warmed_up'),
+                    answer_to_first_audio=('answered', 'first_agent_audio'),
+                    time_to_first_audio=('participant_joined', 'first_agent_audio'),
+                    opening_render=('dialing', 'opening_rendered'),
+                ),
+                'opening_speculative': opening_speculative,
+            }
+            logger.info(f"Call latency for {ctx.room.name}: {Metrics['CALL_LATENCY']}")
+
             call_metrics = json.dumps(Metrics, indent=4, default=serialize_metrics) #JSON format of all metrics for the current session
 
             dt_ist = datetime.datetime.now()
@@ -490,26 +690,41 @@ async def entrypoint(ctx: JobContext):
             room=ctx.room
         )
     )
+    session_started.add_done_callback(lambda _: timeline.mark('session_started'))
 
 
-    #Initiate Call to Customer using provided SIP Trunk
+    #Initiate Call to Customer using provided SIP Trunk; the LLM connection and the opening line are prepared while it rings
+    timeline.mark('dialing')
+    warm_up_task = asyncio.create_task(warm_up(plugins, timeline))
+    opening = SpeculativeUtterance(plugins['tts'], opening_line(context), timeline)
+    opening_speculative = False
     try:
         await ctx.api.sip.create_sip_participant(
             api.CreateSIPParticipantRequest
             (
                 room_name=ctx.room.name,
-                sip_trunk_id=SIP_TRUNK_ID,
+                sip_trunk_id=sip_trunk_id,
                 sip_call_to=phone,
                 participant_identity=customer,
                 wait_until_answered=True
             )
         )
 
+        call_answered = True
+        timeline.mark('answered')
+        asyncio.create_task(report_call_outcome(phone[3:], ctx.room.name, "answered"))
+
         await session_started
         
         participant = await ctx.wait_for_participant(identity=customer)
+        timeline.mark('participant_joined')
         logger.info(f"This participant joined: {participant.identity}")
-        await session.generate_reply(instructions="Follow the **Converstation Flow**")
+        first_frame = await opening.first_frame()
+        if first_frame is None:
+            await session.generate_reply(instructions="Follow the **Converstation Flow**")
+        else:
+            opening_speculative = True
+            await session.say(opening.text, audio=opening.audio(first_frame), allow_interruptions=True)
 
     except api.TwirpError as e:
         logger.error(
@@ -517,6 +732,16 @@ async def entrypoint(ctx: JobContext):
             f"SIP status: {e.metadata.get('sip_status_code')} "
             f"{e.metadata.get('sip_status')}"
         )
+        sip_status_code = e.metadata.get('sip_status_code')
+        if sip_status_code in BUSY_SIP_CODES:
+            outcome = "busy"
+        elif sip_status_code in NO_ANSWER_SIP_CODES:
+            outcome = "no_answer"
+        else:
+            outcome = "failed"
+        await opening.discard()
+        await abandon_warm_up(warm_up_task, plugins)
+        await report_call_outcome(phone[3:], ctx.room.name, outcome, sip_status_code)
         ctx.shutdown()
 
 if __name__ == "__main__":
@@ -524,6 +749,7 @@ if __name__ == "__main__":
     agents.cli.run_app(
         WorkerOptions(
             entrypoint_fnc=entrypoint,
+            prewarm_fnc=prewarm,
             agent_name="Predixion-Voice-Agent",
             ws_url=LIVEKIT_URL,
             api_key=LIVEKIT_API_KEY,
@@ -4,6 +4,7 @@ import json
 from livekit.agents.metrics import LLMMetrics, STTMetrics, TTSMetrics, EOUMetrics
 from azure.storage.blob.aio import BlobServiceClient
 from dotenv import load_dotenv
+import time
 import asyncio
 import aiofiles
 
@@ -43,6 +44,65 @@ async def upload_file_to_blob(file_path, blob_name, max_retries=3):
             else:
                 await asyncio.sleep(2 ** attempt)  # Exponential backoff: 1s, 2s, 4s
 
+class LoopLagMonitor:
+    """
+    Samples how late the event loop wakes up from a short sleep.
+    Any lag here is time the STT/TTS/VAD tasks of the call could not run, i.e. audio stalls.
+    """
+
+    def __init__(self, interval=0.05, stall_threshold=0.1):
+        self.interval = interval
+        self.stall_threshold = stall_threshold
+        self.samples = []
+        self._task = None
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            started = loop.time()
+            await asyncio.sleep(self.interval)
+            self.samples.append(max(loop.time() - started - self.interval, 0.0))
+
+    def stop(self):
+        if self._task:
+            self._task.cancel()
+
+    def summary(self):
+        if not self.samples:
+            return {'samples': 0}
+        ordered = sorted(self.samples)
+        return {
+            'samples': len(ordered),
+            'mean_ms': round(1000 * sum(ordered) / len(ordered), 2),
+            'p95_ms': round(1000 * ordered[int(0.95 * (len(ordered) - 1))], 2),
+            'max_ms': round(1000 * ordered[-1], 2),
+            'stalls': sum(1 for lag in ordered if lag >= self.stall_threshold),
+        }
+
+class CallTimeline:
+    """
+    Monotonic timestamps of the milestones of one call (job start, session start, answer, first agent audio, ...).
+    Only the first occurrence of a milestone is kept; summary() reports the seconds between pairs of them.
+    """
+
+    def __init__(self):
+        self.marks = {'job_started': time.perf_counter()}
+
+    def mark(self, name):
+        self.marks.setdefault(name, time.perf_counter())
+
+    def seconds(self, start, end):
+        if start not in self.marks or end not in self.marks:
+            return None
+        return round(self.marks[end] - self.marks[start], 3)
+
+    def summary(self, **spans):
+        """summary(setup=('job_started', 'session_started')) -> {'setup': 0.412}; spans that never completed are None."""
+        return {name: self.seconds(start, end) for name, (start, end) in spans.items()}
+
 def serialize_metrics(obj):
     if isinstance(obj, (LLMMetrics, STTMetrics, TTSMetrics, EOUMetrics)):
         return obj.__dict__
@@ -1,39 +1,118 @@
+import os
+import re
+import calendar
 from datetime import datetime
+from functools import lru_cache
+import pandas as pd
 from num2words import num2words
 
+# Amounts and dates repeat heavily across borrowers, so conversions are memoized in bounded LRU caches
+VERBALIZE_CACHE_SIZE = int(os.getenv("VERBALIZE_CACHE_SIZE", "4096"))
+
+YEAR_FIRST_DATE = re.compile(r'^(\d{4})-(\d{1,2})-(\d{1,2})$')     # YYYY-MM-DD
+YEAR_LAST_DATE = re.compile(r'^(\d{1,2})-(\d{1,2})-(\d{4})$')      # DD-MM-YYYY or MM-DD-YYYY
+
+@lru_cache(maxsize=VERBALIZE_CACHE_SIZE)
 def date_to_words(date_str):
     """Convert date string to words in English."""
-    possible_formats = [
-        '%Y-%m-%d',  # YYYY-MM-DD
-        '%d-%m-%Y',  # DD-MM-YYYY
-        '%m-%d-%Y'   # MM-DD-YYYY
-    ]
-
-    for fmt in possible_formats:
-        try:
-            formatted_date = datetime.strptime(date_str, fmt)
-            break
-        except ValueError as V:
-            if str(V) == "day is out of range for month":
-                print(f"This date is wrong")
-                raise V
-            else:
-                continue
+    match = YEAR_FIRST_DATE.match(date_str)
+    if match:
+        year, month, day = map(int, match.groups())
     else:
+        match = YEAR_LAST_DATE.match(date_str)
+        if not match:
+            raise ValueError(f"Date '{date_str}' does not match any expected format. Expected formats: YYYY-MM-DD, DD-MM-YYYY, MM-DD-YYYY")
+        first, second, year = map(int, match.groups())
+        # DD-MM-YYYY takes precedence; MM-DD-YYYY only applies when the middle part cannot be a month
+        day, month = (first, second) if 1 <= second <= 12 else (second, first)
+
+    if year < 1 or not 1 <= month <= 12:
         raise ValueError(f"Date '{date_str}' does not match any expected format. Expected formats: YYYY-MM-DD, DD-MM-YYYY, MM-DD-YYYY")
+    if not 1 <= day <= calendar.monthrange(year, month)[1]:
+        print(f"This date is wrong")
+        raise ValueError("day is out of range for month")
 
-    parsed_date = formatted_date.strftime('%d %B')
-    return parsed_date
+    return f"{day:02d} {calendar.month_name[month]}"
 
 def money_to_words(amount):
     """Convert numeric amount to words in Indian Rupees."""
-    money = num2words(str(amount), to='currency', currency='INR', lang='en_IN')
+    return amount_to_words(str(amount))
 
-    if "." in str(amount):
-        index = money.rfind(",")
-        money = money[:index] + " and" + money[index + 1:]
-    else:
+@lru_cache(maxsize=VERBALIZE_CACHE_SIZE)
+def amount_to_words(amount):
+    money = num2words(amount, to='currency', currency='INR', lang='en_IN')
+
+    # num2words always appends ", <n> paise"; keep it joined with "and" only when there are paise to speak
+    rupees, _, paise = money.rpartition(",")
+    if "." in amount:
+        return rupees + " and" + paise
+    return rupees
+
+def money_column_to_words(column):
+    """Vectorized money_to_words: each distinct amount is converted once and mapped back onto the column."""
+    words = {amount: money_to_words(amount) for amount in column.dropna().unique().tolist()}
+    return column.map(words).astype('category')
+
+def parse_date_column(column):
+    """Vectorized date parsing: the formats are tried in date_to_words order, one parse per format for the whole column."""
+    text = column.astype("string")
+    parsed = pd.to_datetime(text, format='%Y-%m-%d', errors='coerce')
+    for fmt in ['%d-%m-%Y', '%m-%d-%Y']:
+        missing = parsed.isna() & text.notna()
+        if not missing.any():
+            break
+        parsed[missing] = pd.to_datetime(text[missing], format=fmt, errors='coerce')
+
+    invalid = parsed.isna() & text.notna()
+    if invalid.any():
+        print(f"These dates do not match any expected format: {text[invalid].tolist()}")
+
+    return parsed
+
+def date_column_to_words(column):
+    """Vectorized date_to_words for a column of date strings or already parsed dates."""
+    if not pd.api.types.is_datetime64_any_dtype(column):
+        column = parse_date_column(column)
+    return column.dt.strftime('%d %B').astype('category')
+
+if __name__ == "__main__":
+    import time
+    import random
+
+    def strptime_date_to_words(date_str):
+        """The previous exception-driven implementation, kept here as the benchmark baseline."""
+        for fmt in ['%Y-%m-%d', '%d-%m-%Y', '%m-%d-%Y']:
+            try:
+                return datetime.strptime(date_str, fmt).strftime('%d %B')
+            except ValueError:
+                continue
+
+    def rfind_money_to_words(amount):
+        """The previous uncached rfind implementation, kept here as the benchmark baseline."""
+        money = num2words(str(amount), to='currency', currency='INR', lang='en_IN')
         index = money.rfind(",")
-        money = money[:index]
+        if "." in str(amount):
+            return money[:index] + " and" + money[index + 1:]
+        return money[:index]
+
+    def per_million(function, values):
+        start = time.perf_counter()
+        for value in values:
+            function(value)
+        elapsed = time.perf_counter() - start
+        return elapsed * 1_000_000 / len(values)
 
-    return money
\ No newline at end of file
+    random.seed(0)
+    amounts = [random.choice([500, 1000, 1500.2, 2500, 12500, 20000, 70000.5]) for _ in range(20_000)]
+    dates = [random.choice(['2025-06-24', '24-06-2025', '06-24-2025', '2025-05-25', '16-01-2026']) for _ in range(200_000)]
+
+    benchmarks = [
+        ("money_to_words", rfind_money_to_words, money_to_words, amounts),
+        ("money_to_words (no cache)", rfind_money_to_words, lambda amount: amount_to_words.__wrapped__(str(amount)), amounts),
+        ("date_to_words", strptime_date_to_words, date_to_words, dates),
+        ("date_to_words (no cache)", strptime_date_to_words, date_to_words.__wrapped__, dates),
+    ]
+    for name, before, after, values in benchmarks:
+        before_time = per_million(before, values)
+        after_time = per_million(after, values)
+        print(f"{name}: {before_time:.2f}s -> {after_time:.2f}s per million conversions ({before_time / after_time:.1f}x)")
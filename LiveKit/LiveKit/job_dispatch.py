@@ -4,9 +4,10 @@ from dotenv import load_dotenv
 load_dotenv()
 
 import asyncio
-import numpy as np
+import uuid
 import json
 from superAgent import SuperAgent
+from dispatch_context import build_context, compact_metadata
 import argparse
 
 from livekit import api
@@ -17,29 +18,15 @@ async def create_explicit_dispatch(customer_phone : int):
     LIVEKIT_URL = os.getenv('LIVEKIT_URL')
     LIVEKIT_API_KEY = os.getenv("LIVEKIT_API_KEY")
     LIVEKIT_API_SECRET = os.getenv("LIVEKIT_API_SECRET")
-    room_name = f'livekit_room_{np.random.randint(10 ** 8, 10 ** 9 - 1)}'
+    room_name = f'livekit_room_{uuid.uuid4().hex}'
 
     superagent = SuperAgent()
     superagent.read_document('borrower.csv')
-    user_info = superagent.agent_context(customer_phone)
+    user_info = await superagent.agent_context(customer_phone)
+    if 'Error' in user_info:
+        raise Exception(user_info['Error'])
 
-    metadata = {
-        'phone': f"+91{customer_phone}",
-        'first_name': user_info['first_name'],
-        'last_name': user_info['last_name'],
-        'balance_to_pay': user_info['balance_to_pay'],
-        'installment': user_info['installment'],
-        'due_date': user_info['due_date'],
-        'pending_days': user_info['pending_days'],
-        'outstanding_amount': user_info['balance_to_pay'],
-        'minimum_due_amount': user_info['minimum_due_amount'],
-        'late_fees': user_info['late_fees'],
-        'interest_rate': user_info['interest_rate'],
-        'emi_eligible': user_info['emi_eligible'],
-        'whatsapp_summary': user_info['whatsapp_summary'],
-        'call_summary': user_info['call_summary'],
-        'use_context' : False,
-    }
+    metadata = compact_metadata(build_context(customer_phone, user_info))
     # print(metadata)
 
     lkapi = api.LiveKitAPI(
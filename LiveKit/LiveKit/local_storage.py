@@ -0,0 +1,235 @@
+"""
+Local stand-ins for the storage backends, for benchmarks and offline load tests.
+
+LocalDatabase keeps the Database interface (users, messages and rolling summaries) on a SQLite
+file, and LocalUserData serves the borrower file from the local filesystem instead of Azure Blob
+Storage. Both add STORAGE_LATENCY_MS (+/- STORAGE_JITTER_MS) to every round trip so different
+storage strategies can be compared under the same simulated network cost.
+
+Select them with STORAGE_BACKEND=local; see create_database / create_user_data in context_manager.
+The images ship no borrower data: mount the borrower file's directory and point LOCAL_FILES_DIR at it.
+LiveKit/user_files holds a synthetic borrower.csv for running the worker from a checkout.
+"""
+
+import os
+import time
+import random
+import sqlite3
+import asyncio
+import threading
+from datetime import datetime
+
+from context_manager import Database, UserData
+from blocking_io import run_blocking
+
+LOCAL_DIR = os.path.dirname(os.path.abspath(__file__))
+LOCAL_DB_PATH = os.getenv("LOCAL_DB_PATH", os.path.join(LOCAL_DIR, "cache", "local_storage.db"))
+LOCAL_FILES_DIR = os.getenv("LOCAL_FILES_DIR", os.path.join(LOCAL_DIR, "user_files"))
+STORAGE_LATENCY_MS = float(os.getenv("STORAGE_LATENCY_MS", "0"))
+STORAGE_JITTER_MS = float(os.getenv("STORAGE_JITTER_MS", "0"))
+
+SCHEMA = """
+create table if not exists agent_users (
+    phone        text primary key,
+    whatsapp_id  text,
+    chat_id      text,
+    name         text
+);
+create table if not exists agent_messages (
+    id          integer primary key autoincrement,
+    phone       text not null references agent_users (phone),
+    channel     text not null check (channel in ('voice', 'whatsapp')),
+    speaker     text not null,
+    content     text not null,
+    created_at  text not null
+);
+create index if not exists agent_messages_phone_channel_id_idx on agent_messages (phone, channel, id desc);
+create table if not exists agent_summaries (
+    phone               text not null references agent_users (phone),
+    channel             text not null check (channel in ('voice', 'whatsapp')),
+    summary             text not null,
+    summarized_through  integer not null,
+    updated_at          text not null,
+    primary key (phone, channel)
+);
+"""
+
+
+def injected_latency():
+    """Seconds of simulated network time for one round trip."""
+    latency = STORAGE_LATENCY_MS + random.uniform(-STORAGE_JITTER_MS, STORAGE_JITTER_MS)
+    return max(latency, 0.0) / 1000
+
+
+class LocalDatabase(Database):
+    """SQLite implementation of the Database interface; every method costs one simulated round trip."""
+
+    _connection = None
+    _connection_lock = threading.Lock()
+    _stats = {"requests": 0, "in_flight": 0, "errors": 0, "total_latency_ms": 0.0}
+
+    def __init__(self, path=LOCAL_DB_PATH):
+        self.path = path
+
+    def connection(self):
+        with LocalDatabase._connection_lock:
+            if LocalDatabase._connection is None:
+                os.makedirs(os.path.dirname(self.path), exist_ok=True)
+                connection = sqlite3.connect(self.path, check_same_thread=False)
+                connection.execute("pragma journal_mode=wal")
+                connection.execute("pragma foreign_keys=on")
+                connection.executescript(SCHEMA)
+                LocalDatabase._connection = connection
+            return LocalDatabase._connection
+
+    def execute(self, sql, parameters=(), many=False):
+        connection = self.connection()
+        with LocalDatabase._connection_lock, connection:
+            if many:
+                connection.executemany(sql, parameters)
+                return []
+            return connection.execute(sql, parameters).fetchall()
+
+    async def round_trip(self, sql, parameters=(), many=False):
+        stats = LocalDatabase._stats
+        stats["requests"] += 1
+        stats["in_flight"] += 1
+        started = time.perf_counter()
+        try:
+            await asyncio.sleep(injected_latency())
+            return await run_blocking("db", self.execute, sql, parameters, many)
+        except Exception:
+            stats["errors"] += 1
+            raise
+        finally:
+            stats["in_flight"] -= 1
+            stats["total_latency_ms"] += 1000 * (time.perf_counter() - started)
+
+    @classmethod
+    def pool_stats(cls):
+        stats = dict(cls._stats)
+        stats["open_connections"] = 0 if cls._connection is None else 1
+        stats["mean_latency_ms"] = round(stats["total_latency_ms"] / stats["requests"], 2) if stats["requests"] else 0.0
+        return stats
+
+    @classmethod
+    async def aclose(cls):
+        with cls._connection_lock:
+            if cls._connection is not None:
+                cls._connection.close()
+                cls._connection = None
+
+    async def init_user(self, phone: str, wa_id=None, chat_id=None, name=None):
+        await self.round_trip(
+            "insert into agent_users (phone, whatsapp_id, chat_id, name) values (?, ?, ?, ?) on conflict (phone) do nothing",
+            (phone, wa_id, chat_id, name)
+        )
+        return phone
+
+    async def add_convo(self, ref, agent, msg):
+        if agent not in ("voice", "whatsapp"):
+            raise Exception("Invalid Agent")
+        if not isinstance(msg, list):
+            raise ValueError("msg must be a list of message dictionaries")
+        if not msg:
+            return
+
+        rows = []
+        for message in msg:
+            speaker, text = next((key, value) for key, value in message.items() if key != "timestamp")
+            rows.append((ref, agent, speaker, text, message.get("timestamp") or datetime.now().isoformat()))
+
+        try:
+            await self.round_trip(
+                "insert into agent_messages (phone, channel, speaker, content, created_at) values (?, ?, ?, ?, ?)",
+                rows,
+                many=True
+            )
+        except sqlite3.IntegrityError:
+            raise Exception("User does not exist")
+
+    async def get_convo(self, ref, agent, limit=10, offset=0):
+        if agent not in ("voice", "whatsapp"):
+            raise Exception("Invalid Agent")
+
+        rows = await self.round_trip(
+            "select speaker, content from agent_messages where phone = ? and channel = ? order by id desc limit ? offset ?",
+            (ref, agent, limit, offset)
+        )
+        return [{speaker: content} for speaker, content in reversed(rows)]
+
+    async def get_convos(self, ref, agents=("whatsapp", "voice"), limit=10):
+        rows = await self.round_trip(
+            """
+            select channel, speaker, content from (
+                select id, channel, speaker, content,
+                       row_number() over (partition by channel order by id desc) as recency
+                from agent_messages where phone = ?
+            ) where recency <= ? order by channel, id
+            """,
+            (ref, limit)
+        )
+
+        conversations = {agent: [] for agent in agents}
+        for channel, speaker, content in rows:
+            if channel in conversations:
+                conversations[channel].append({speaker: content})
+        return conversations
+
+    async def get_summary_state(self, ref, agents=("whatsapp", "voice"), limit=None):
+        rows = await self.round_trip(
+            """
+            select channel, summary, summarized_through, null, null, null from agent_summaries where phone = ?
+            union all
+            select channel, null, null, id, speaker, content from (
+                select m.id, m.channel, m.speaker, m.content,
+                       row_number() over (partition by m.channel order by m.id) as position
+                from agent_messages as m
+                left join agent_summaries as s on s.phone = m.phone and s.channel = m.channel
+                where m.phone = ? and m.id > coalesce(s.summarized_through, 0)
+            ) where ? is null or position <= ?
+            order by 1, 4 nulls first
+            """,
+            (ref, ref, limit, limit)
+        )
+
+        state = {agent: {"summary": None, "summarized_through": 0, "messages": [], "last_id": 0} for agent in agents}
+        for channel_name, summary, summarized_through, message_id, speaker, content in rows:
+            if channel_name not in state:
+                continue
+            channel = state[channel_name]
+            if message_id is None:
+                channel["summary"] = summary
+                channel["summarized_through"] = channel["last_id"] = summarized_through
+            else:
+                channel["messages"].append({speaker: content})
+                channel["last_id"] = message_id
+        return state
+
+    async def save_summaries(self, ref, summaries):
+        if not summaries:
+            return
+        updated_at = datetime.now().isoformat()
+        await self.round_trip(
+            """
+            insert into agent_summaries (phone, channel, summary, summarized_through, updated_at) values (?, ?, ?, ?, ?)
+            on conflict (phone, channel) do update set
+                summary = excluded.summary, summarized_through = excluded.summarized_through, updated_at = excluded.updated_at
+            """,
+            [(ref, agent, summary, through, updated_at) for agent, (summary, through) in summaries.items()],
+            many=True
+        )
+
+
+class LocalUserData(UserData):
+    """UserData that reads the borrower file from LOCAL_FILES_DIR instead of Azure Blob Storage."""
+
+    def __init__(self, files_dir=LOCAL_FILES_DIR):
+        super().__init__()
+        self.files_dir = files_dir
+
+    def sync_file(self, file_name="borrower.csv"):
+        time.sleep(injected_latency())
+        local_path = os.path.join(self.files_dir, file_name)
+        stat = os.stat(local_path)
+        return local_path, f'"{stat.st_mtime_ns}-{stat.st_size}"'
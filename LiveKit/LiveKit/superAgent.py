@@ -1,5 +1,7 @@
 import time
 import os
+import random
+import asyncio
 from dotenv import load_dotenv
 load_dotenv()
 
@@ -8,11 +10,18 @@ from langchain_groq import ChatGroq
 from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
 from langchain_core.messages import ToolMessage, HumanMessage, SystemMessage, AIMessage
 from langchain.tools import tool
+from groq import APIConnectionError, APIStatusError
 
-from context_manager import UserData, Database
+from context_manager import create_user_data, create_database
+from channel_router import ChannelRouter
+
+NO_CONVERSATION = "No prior conversation occurred."
+SUMMARY_BUDGET_SECONDS = float(os.getenv("SUMMARY_BUDGET_SECONDS", "6"))
+SUMMARY_MAX_ATTEMPTS = int(os.getenv("SUMMARY_MAX_ATTEMPTS", "4"))
+SUMMARY_BACKOFF_SECONDS = float(os.getenv("SUMMARY_BACKOFF_SECONDS", "0.5"))
 
 class SuperAgent:
-    def __init__(self):
+    def __init__(self, borrowers=None):
         self.llm = ChatMistralAI(
             model="mistral-large-latest",
             temperature=0,
@@ -23,15 +32,15 @@ class SuperAgent:
         self.summarizer = ChatGroq(
             model='llama3-70b-8192',
             temperature=0.2,
-            max_retries=5,
+            max_retries=0,      #Retries are handled by summarize_channel so they stay inside the dispatch budget
             api_key=os.getenv('GROQ_API_KEY')
         )
 
         self.twillio_api='' #for connecting to voice agent
         self.meta_api='' #for connecting to whatsapp agent
 
-        self.client = Database()
-        self.file = UserData()
+        self.client = create_database()
+        self.file = borrowers or create_user_data()     #Anything with fetch_user, e.g. the process-wide BorrowerStore
 
         whatsapp_agent = tool(self.whatsapp_agent)
         voice_agent = tool(self.voice_agent)
@@ -42,6 +51,7 @@ class SuperAgent:
         }
 
         self.preference = 'call' #temporaryily added to prevent unpredictable behavior of LLM
+        self.router = ChannelRouter()
 
         summary_template = """You are a simple chat conversation summarizer. 
         Summarize the given chat conversation which is provided in JSON format.
@@ -49,6 +59,12 @@ class SuperAgent:
         Mention important details in the summary which can be used by a LLM as context.
         """
 
+        update_template = """You are a simple chat conversation summarizer. 
+        You are given the summary of a chat conversation so far and the new messages of that conversation, provided in JSON format.
+        Rewrite the summary so that it also covers the new messages.
+        Mention important details in the summary which can be used by a LLM as context.
+        """
+
         decision_template = f"""You are an intelligent decision making model. 
         You have to use my response to decide between using either the 'whatsapp_agent' or the 'voice_agent'.
         If my response does not mention any preference for the agent use this preference: {self.preference}
@@ -77,33 +93,114 @@ class SuperAgent:
         ]
         self.summary_prompt_template = ChatPromptTemplate.from_messages(template_messages)
 
+        template_messages = [
+            SystemMessage(content=update_template),
+            ("human", "Summary so far:\n{summary}\n\nNew messages:\n{conversation}")
+        ]
+        self.update_prompt_template = ChatPromptTemplate.from_messages(template_messages)
+
     def read_document(self, file_name):
         self.file.read_file(file_name)
         self.all_user_data = self.file.Data
 
-    def generate_summary(self,phone):
-        uri = self.client.init_user(phone=str(phone))
-        whatsapp_convo = self.client.get_convo(ref=uri, agent='whatsapp')
-        voice_convo = self.client.get_convo(ref=uri, agent='voice')
+    async def generate_summary(self,phone):
+        #Creating the user row and reading the stored summaries with the messages added since are independent round trips
+        deadline = asyncio.get_running_loop().time() + SUMMARY_BUDGET_SECONDS
+        uri = str(phone)
+        _, state = await asyncio.gather(
+            self.client.init_user(phone=uri),
+            self.client.get_summary_state(ref=uri, agents=('whatsapp', 'voice'))
+        )
         print(f'Fetched Conversation')
 
+        whatsapp_summary, voice_summary = await self.summarize(state['whatsapp'], state['voice'], deadline)
+
+        #Only summaries that took in new messages are written back; an unchanged one is already stored
+        fresh = {
+            agent: (summary, state[agent]['last_id'])
+            for agent, summary in (('whatsapp', whatsapp_summary), ('voice', voice_summary))
+            if summary is not None and state[agent]['messages']
+        }
         try:
-            message = self.summary_prompt_template.format_messages(conversation=whatsapp_convo)
-            whatsapp_context = self.summarizer.invoke(message)
-            time.sleep(1)
-            message = self.summary_prompt_template.format_messages(conversation=voice_convo)
-            voice_context = self.summarizer.invoke(message)
-            return whatsapp_context.content, voice_context.content
+            await self.client.save_summaries(ref=uri, summaries=fresh)
         except Exception as e:
-            print(e)
-            return "No prior conversation occurred.","No prior conversation occurred."
+            print(f'Could not store the conversation summaries: {e}')
 
-    def agent_context(self,phone):
-        customer_data = self.file.fetch_user(phone_no=phone)
-        customer_data['whatsapp_summary'], customer_data['call_summary'] = self.generate_summary(phone=phone)
+        #A channel whose summarizer failed or missed the budget falls back to its stored (possibly stale) summary
+        return (
+            whatsapp_summary or state['whatsapp']['summary'] or NO_CONVERSATION,
+            voice_summary or state['voice']['summary'] or NO_CONVERSATION
+        )
+
+    async def summarize(self, whatsapp_state, voice_state, deadline):
+        """Summarizes both channels concurrently; a channel not done by the deadline, or that failed, comes back as None."""
+        tasks = [
+            asyncio.create_task(self.summarize_channel(whatsapp_state, deadline)),
+            asyncio.create_task(self.summarize_channel(voice_state, deadline))
+        ]
+        timeout = max(deadline - asyncio.get_running_loop().time(), 0)
+        done, pending = await asyncio.wait(tasks, timeout=timeout)
+        for task in pending:
+            task.cancel()
+            print('Summary exceeded the dispatch latency budget, using the fallback.')
+
+        summaries = []
+        for task in tasks:
+            if task in done and task.exception() is None:
+                summaries.append(task.result())
+            else:
+                if task in done:
+                    print(task.exception())
+                summaries.append(None)
+        return tuple(summaries)
+
+    async def summarize_channel(self, state, deadline):
+        """
+        Brings the channel's rolling summary up to date: the stored summary is reused as is when no message was
+        added since, folded together with only the new messages when some were, and built from scratch otherwise.
+        """
+        if not state['messages']:
+            return state['summary'] or NO_CONVERSATION
+
+        if state['summary']:
+            message = self.update_prompt_template.format_messages(summary=state['summary'], conversation=state['messages'])
+        else:
+            message = self.summary_prompt_template.format_messages(conversation=state['messages'])
+
+        loop = asyncio.get_running_loop()
+        for attempt in range(SUMMARY_MAX_ATTEMPTS):
+            try:
+                summary = await self.summarizer.ainvoke(message)
+                return summary.content
+            except (APIConnectionError, APIStatusError) as e:
+                status = getattr(e, "status_code", None)
+                if status is not None and status != 429 and status < 500:
+                    raise
+                if attempt == SUMMARY_MAX_ATTEMPTS - 1:
+                    raise
+
+                #Honour the server's Retry-After on 429s, otherwise back off exponentially with jitter
+                delay = retry_after(e)
+                if delay is None:
+                    delay = SUMMARY_BACKOFF_SECONDS * (2 ** attempt) * random.uniform(0.5, 1.5)
+                if loop.time() + delay >= deadline:
+                    raise
+                await asyncio.sleep(delay)
+
+    async def agent_context(self,phone,customer_data=None):
+        #customer_data can be passed in when the borrower was already resolved, e.g. by a bulk fetch_users
+        if customer_data is None:
+            customer_data = self.file.fetch_user(phone_no=phone)
+        if 'Error' in customer_data:
+            return customer_data        #Not a borrower: no agent-users row and no summarizer calls
+        customer_data['whatsapp_summary'], customer_data['call_summary'] = await self.generate_summary(phone=phone)
         return customer_data
 
     def decide_agent(self, response):
+        #Obvious replies are settled by keyword rules or the preference; only ambiguous ones reach the LLM
+        return self.router.route(response, self.preference, self.ask_arbiter)
+
+    def ask_arbiter(self, response):
         messages = self.decision_prompt_template.format_messages(response=response)
         decision = self.arbiter.invoke(messages)
         agent = decision.additional_kwargs['tool_calls'][0]['function']['name']
@@ -125,3 +222,14 @@ class SuperAgent:
         """
         print('____________________________Function Called the Voice Agent_________________________')
         return {'Super Agent Response':'Connected to the Voice Agent'}
+
+
+def retry_after(error):
+    """Seconds the API asked us to wait in its Retry-After header, if it sent one."""
+    response = getattr(error, "response", None)
+    if response is None:
+        return None
+    try:
+        return float(response.headers.get("retry-after"))
+    except (TypeError, ValueError):
+        return None
@@ -0,0 +1,146 @@
+import os
+import json
+import glob
+import fcntl
+import asyncio
+import datetime
+import logging
+
+from context_manager import create_database
+
+logger = logging.getLogger("voice-agent")
+
+JOURNAL_DIR = os.getenv("TRANSCRIPT_JOURNAL_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "journal"))
+FLUSH_INTERVAL = float(os.getenv("TRANSCRIPT_FLUSH_SECONDS", "5"))
+BATCH_SIZE = int(os.getenv("TRANSCRIPT_BATCH_SIZE", "20"))
+
+
+class TranscriptJournal:
+    """
+    Write-ahead log of one call's transcript.
+
+    Every turn is appended to a local JSONL file the moment it is added to the conversation, and a
+    background task ships unsent turns to the Database in batches. Shutdown therefore only flushes
+    a short tail, and if the worker dies the journal stays on disk for the next process to replay.
+    """
+
+    def __init__(self, room_name, phone, name, journal_dir=JOURNAL_DIR):
+        os.makedirs(journal_dir, exist_ok=True)
+        self.path = os.path.join(journal_dir, f"{room_name}.jsonl")
+        self.phone = phone
+        self.name = name
+        self.pending = []
+        self.sent = 0
+        self.user_created = False
+        self.closed = False
+        self.dropped = 0
+        #Locked under a temporary name and only then moved into place, so replay never sees it unlocked and empty
+        creating = f"{self.path}.creating"
+        self._file = open(creating, "a", encoding="utf-8")
+        fcntl.flock(self._file, fcntl.LOCK_EX | fcntl.LOCK_NB)     #Marks the journal as owned by a live call
+        os.replace(creating, self.path)
+        self._flush_lock = asyncio.Lock()
+        self._closing = asyncio.Event()
+        self._task = None
+
+    def start(self):
+        self._task = asyncio.create_task(self._flush_loop())
+
+    def append(self, speaker, text, timestamp=None):
+        if self.closed:
+            if not self.dropped:
+                logger.warning(f"Transcript turns added after the journal of {os.path.basename(self.path)} was closed are not stored")
+            self.dropped += 1
+            return
+        entry = {
+            "phone": self.phone,
+            "name": self.name,
+            "speaker": speaker,
+            "text": text,
+            "timestamp": timestamp or datetime.datetime.now().isoformat()
+        }
+        self._file.write(json.dumps(entry, ensure_ascii=False) + "\n")
+        self._file.flush()
+        self.pending.append(entry)
+
+    async def _flush_loop(self):
+        while not self._closing.is_set():
+            try:
+                await asyncio.wait_for(self._closing.wait(), timeout=FLUSH_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.error(f"Transcript flush failed, will retry: {e}")
+
+    async def flush(self):
+        async with self._flush_lock:
+            while self.pending:
+                batch = self.pending[:BATCH_SIZE]
+                await ship(self.phone, self.name, batch, create_user=not self.user_created)
+                self.user_created = True
+                del self.pending[:len(batch)]
+                self.sent += len(batch)
+                write_sent(self.path, self.sent)
+
+    async def close(self):
+        """Stops the background flusher, ships the remaining tail and removes the journal once it is all stored."""
+        #Let an in-flight batch finish rather than cancelling it halfway and sending it twice
+        self._closing.set()
+        if self._task:
+            await self._task
+        await self.flush()
+        self.closed = True
+        self._file.close()
+        discard(self.path)
+
+    @classmethod
+    async def replay(cls, journal_dir=JOURNAL_DIR):
+        """Ships the unsent tail of journals left behind by crashed workers; journals of live calls are locked and skipped."""
+        for path in glob.glob(os.path.join(journal_dir, "*.jsonl")):
+            try:
+                with open(path, "r", encoding="utf-8") as journal:
+                    try:
+                        fcntl.flock(journal, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    except BlockingIOError:
+                        continue
+                    if not os.path.exists(path):        #Another process replayed it while we waited
+                        continue
+
+                    entries = [json.loads(line) for line in journal if line.strip()]
+                    unsent = entries[read_sent(path):]
+                    if unsent:
+                        await ship(unsent[0]["phone"], unsent[0]["name"], unsent, create_user=True)
+                        logger.info(f"Replayed {len(unsent)} journaled turns from {os.path.basename(path)}")
+                    discard(path)
+            except Exception as e:
+                logger.error(f"Could not replay transcript journal {path}: {e}")
+
+
+async def ship(phone, name, entries, create_user):
+    db = create_database()
+    if create_user:
+        await db.init_user(phone=phone, name=name)
+    history = [db.payload(name=entry["speaker"], text=entry["text"], time=entry["timestamp"]) for entry in entries]
+    await db.add_convo(ref=phone, agent='voice', msg=history)
+
+
+def read_sent(path):
+    try:
+        with open(f"{path}.sent", "r") as sent_file:
+            return int(sent_file.read() or 0)
+    except FileNotFoundError:
+        return 0
+
+
+def write_sent(path, sent):
+    with open(f"{path}.sent.tmp", "w") as sent_file:
+        sent_file.write(str(sent))
+    os.replace(f"{path}.sent.tmp", f"{path}.sent")
+
+
+def discard(path):
+    for leftover in (path, f"{path}.sent"):
+        if os.path.exists(leftover):
+            os.remove(leftover)
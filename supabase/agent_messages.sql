@@ -0,0 +1,42 @@
+-- Append-only conversation storage used by Database.add_convo / Database.get_convo.
+-- One row per message instead of the whole history in "agent-users".call_transcripts / whatsapp_messages.
+
+create table if not exists "agent-messages" (
+    id          bigint generated always as identity primary key,
+    phone       text not null references "agent-users" (phone) on delete cascade,
+    channel     text not null check (channel in ('voice', 'whatsapp')),
+    speaker     text not null,
+    content     text not null,
+    created_at  timestamptz not null default now()
+);
+
+-- get_convo reads the latest N messages of one channel for one phone
+create index if not exists agent_messages_phone_channel_id_idx
+    on "agent-messages" (phone, channel, id desc);
+
+-- Records one-off data migrations so that re-running this file does not repeat them
+create table if not exists "agent-migrations" (
+    name    text primary key,
+    ran_at  timestamptz not null default now()
+);
+
+-- One-off backfill of the histories stored as JSON arrays on "agent-users".
+-- The marker row is claimed in the same statement, so a second run (or a concurrent one) copies nothing.
+with marker as (
+    insert into "agent-migrations" (name) values ('agent-messages-backfill')
+    on conflict (name) do nothing
+    returning name
+)
+insert into "agent-messages" (phone, channel, speaker, content, created_at)
+select history.phone, history.channel, message.key, message.value,
+       coalesce((history.msg ->> 'timestamp')::timestamptz, now())
+from (
+    select phone, 'voice' as channel, msg, position
+    from "agent-users", jsonb_array_elements(call_transcripts) with ordinality as t(msg, position)
+    union all
+    select phone, 'whatsapp' as channel, msg, position
+    from "agent-users", jsonb_array_elements(whatsapp_messages) with ordinality as t(msg, position)
+) as history,
+jsonb_each_text(history.msg - 'timestamp') as message
+where exists (select 1 from marker)
+order by history.phone, history.channel, history.position;
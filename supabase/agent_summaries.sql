@@ -0,0 +1,36 @@
+-- Rolling conversation summaries used by Database.get_summary_state / Database.save_summaries.
+-- A summary covers every message of its channel up to summarized_through ("agent-messages".id),
+-- so the next dispatch only summarizes the messages added since, or nothing at all.
+
+create table if not exists "agent-summaries" (
+    phone               text not null references "agent-users" (phone) on delete cascade,
+    channel             text not null check (channel in ('voice', 'whatsapp')),
+    summary             text not null,
+    summarized_through  bigint not null,
+    updated_at          timestamptz not null default now(),
+    primary key (phone, channel)
+);
+
+-- Stored summary of every channel plus the messages newer than it, in a single round trip.
+-- Summary rows have a null id; message rows have a null summary.
+-- All new messages are returned by default. With p_limit only the oldest p_limit of them are, so the
+-- summary still covers a contiguous range and the rest are picked up by the next dispatch.
+create or replace function summary_state(p_phone text, p_limit int default null)
+returns table (channel text, summary text, summarized_through bigint, id bigint, speaker text, content text)
+language sql stable
+as $$
+    select s.channel, s.summary, s.summarized_through, null::bigint, null::text, null::text
+    from "agent-summaries" as s
+    where s.phone = p_phone
+    union all
+    select latest.channel, null, null, latest.id, latest.speaker, latest.content
+    from (
+        select m.id, m.channel, m.speaker, m.content,
+               row_number() over (partition by m.channel order by m.id) as position
+        from "agent-messages" as m
+        left join "agent-summaries" as s on s.phone = m.phone and s.channel = m.channel
+        where m.phone = p_phone and m.id > coalesce(s.summarized_through, 0)
+    ) as latest
+    where p_limit is null or latest.position <= p_limit
+    order by 1, 4 nulls first;
+$$;
@@ -0,0 +1,17 @@
+-- Latest N messages of every channel for one phone, used by Database.get_convos.
+-- Lets the dispatch path read the WhatsApp and voice histories in a single round trip.
+
+create or replace function recent_messages(p_phone text, p_limit int default 10)
+returns table (id bigint, channel text, speaker text, content text)
+language sql stable
+as $$
+    select id, channel, speaker, content
+    from (
+        select id, channel, speaker, content,
+               row_number() over (partition by channel order by id desc) as recency
+        from "agent-messages"
+        where phone = p_phone
+    ) as latest
+    where recency <= p_limit
+    order by channel, id;
+$$;